@@ -0,0 +1,76 @@
+"""
+Microbenchmark comparing the per-response cost of DjangoPJAXMiddleware's
+pre-built response processors with applying its decorators to a throwaway
+view for every response, as the middleware used to.
+
+Run from the repository root:
+
+    python benchmarks/middleware.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa
+
+settings.configure()
+
+import django  # noqa
+if django.VERSION >= (1, 7):
+    django.setup()
+
+from django.template.response import TemplateResponse  # noqa
+from django.test.client import RequestFactory  # noqa
+
+from djpj.middleware import DjangoPJAXMiddleware  # noqa
+
+CONFIGURATION = (
+    ('^/shop/', ('@pjax_template()', '@pjax_block(title_block="title")')),
+)
+
+rf = RequestFactory()
+template = 'product.html'  # Never rendered, so it needn't exist.
+middleware = DjangoPJAXMiddleware(CONFIGURATION)
+_, decorators = middleware.decorated_urls[0]
+processors = [decorator.process_response for decorator in decorators]
+
+
+def requests():
+    return (rf.get('/shop/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER='#main'),
+            rf.get('/shop/'))
+
+
+def per_response_decorators():
+    for request in requests():
+        response = TemplateResponse(request, template)
+        fake_view = lambda _: response
+        for decorator in decorators:
+            response = decorator(fake_view)(request)
+
+
+def prebuilt_processors():
+    for request in requests():
+        response = TemplateResponse(request, template)
+        for process_response in processors:
+            response = process_response(request, response)
+
+
+def baseline():
+    for request in requests():
+        TemplateResponse(request, template)
+
+
+def main(number=20000, repeat=5):
+    timings = dict(
+        (fn.__name__, min(timeit.repeat(fn, number=number, repeat=repeat)))
+        for fn in (baseline, per_response_decorators, prebuilt_processors))
+    base = timings.pop('baseline')
+    print("Per request pair, excluding request and response construction:")
+    for name, timing in sorted(timings.items()):
+        print("  %-25s %8.2f us" % (name, (timing - base) / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Benchmarks for DjPj's render paths, across synthetic templates of various
+shapes: inheritance depth, number of blocks, position of the target block,
+and the amount of work done outside it.
+
+Run from the repository root:
+
+    python benchmarks/suite.py                      # run everything
+    python benchmarks/suite.py -k direct            # only matching benchmarks
+    python benchmarks/suite.py --save base.json     # store results
+    python benchmarks/suite.py --compare base.json  # fail on regressions
+
+Each benchmark reports latency percentiles and the peak memory allocated by
+a single operation. With --compare, the exit status is 1 if any benchmark's
+median latency has grown by more than --threshold (10% by default).
+"""
+import argparse
+import gc
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Shape(object):
+    """
+    The shape of a synthetic template hierarchy. The leaf template extends
+    depth - 1 ancestors; the root has the given number of blocks, with the
+    target block first or last, and a {% for %} loop of loop_size iterations
+    before and after its blocks.
+    """
+
+    def __init__(self, depth, blocks, target_late, loop_size):
+        self.depth = depth
+        self.blocks = blocks
+        self.target_late = target_late
+        self.loop_size = loop_size
+
+    @property
+    def name(self):
+        return 'd%d-b%d-%s-loop%d' % (self.depth, self.blocks,
+                                      'late' if self.target_late else 'early',
+                                      self.loop_size)
+
+    def template_name(self, level):
+        return '%s/level%d.html' % (self.name, level)
+
+    @property
+    def leaf(self):
+        return self.template_name(self.depth - 1)
+
+    def templates(self):
+        loop = ('{% for i in items %}<li class="{% cycle "a" "b" %}">'
+                '{{ i|add:1 }}</li>{% endfor %}')
+        blocks = ['{%% block b%d %%}<p>block %d {{ title }}</p>{%% endblock %%}'
+                  % (i, i) for i in range(self.blocks)]
+        target = ('{% block target %}{% with colour="orange" %}'
+                  '{% for i in small_items %}{{ colour }} {{ i }}{% endfor %}'
+                  '{% endwith %}{% endblock %}')
+        blocks.insert(len(blocks) if self.target_late else 0, target)
+        root = ('<html><head>{% block title %}{{ title }}{% endblock %}</head>'
+                '<ul>' + loop + '</ul>' + ''.join(blocks) +
+                '<ul>' + loop + '</ul></html>')
+        templates = {self.template_name(0): root}
+        for level in range(1, self.depth):
+            overrides = ''.join(
+                '{%% block b%d %%}{{ block.super }} level %d{%% endblock %%}'
+                % (i, level) for i in range(level, self.blocks, self.depth))
+            templates[self.template_name(level)] = (
+                '{%% extends "%s" %%}%s{%% block target %%}{{ block.super }}'
+                '{%% endblock %%}' % (self.template_name(level - 1), overrides))
+        return templates
+
+
+SHAPES = [
+    Shape(1, 10, True, 10),
+    Shape(3, 100, False, 100),
+    Shape(3, 100, True, 100),
+    Shape(6, 300, False, 100),
+    Shape(6, 300, True, 100),
+    Shape(3, 100, True, 5000),
+]
+
+PATTERN_COUNT = 200
+
+
+def setup_django():
+    from django.conf import settings
+    templates = {}
+    for shape in SHAPES:
+        templates.update(shape.templates())
+    settings.configure(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {'loaders': [('django.template.loaders.cached.Loader', [
+            ('django.template.loaders.locmem.Loader', templates)])]},
+    }])
+    import django
+    django.setup()
+
+
+def benchmarks():
+    """Yield (name, setup) pairs, where setup() returns an operation."""
+    from django.template import engines
+    from django.template.context import make_context
+    from django.template.response import TemplateResponse
+    from django.test.client import RequestFactory
+    from django.test.utils import override_settings
+
+    from djpj.decorator import pjax_block, pjax_template
+    from djpj.middleware import DjangoPJAXMiddleware
+    from djpj.template import BlockIndex, DjPjTemplate
+
+    rf = RequestFactory()
+    engine = engines['django']
+
+    def context_data():
+        return {'title': 'Title', 'items': range(shape.loop_size),
+                'small_items': range(10)}
+
+    def view(request, template_name):
+        return TemplateResponse(request, template_name, context_data())
+
+    def request(pjax):
+        if pjax:
+            return rf.get('/page/', HTTP_X_PJAX=True,
+                          HTTP_X_PJAX_CONTAINER='#target')
+        return rf.get('/page/')
+
+    def render_view(decorated, pjax, **settings):
+        def setup():
+            def operation():
+                with override_settings(**settings):
+                    decorated(request(pjax), shape.leaf).render()
+            return operation
+        return setup
+
+    for shape in SHAPES:
+        leaf = shape.leaf
+        block_view = pjax_block(title_block='title')(view)
+        yield ('full/%s' % shape.name, render_view(block_view, False))
+        yield ('pjax_block/%s' % shape.name, render_view(block_view, True))
+        yield ('pjax_block-unpatched/%s' % shape.name,
+               render_view(block_view, True, DJPJ_PATCH_TEMPLATES=False))
+        yield ('pjax_block-direct/%s' % shape.name,
+               render_view(block_view, True, DJPJ_RENDER_BLOCKS_DIRECTLY=True))
+
+        def index_setup(leaf=leaf):
+            template = engine.get_template(leaf).template
+            return lambda: BlockIndex(template)
+        yield ('block_index/%s' % shape.name, index_setup)
+
+        def render_blocks_setup(leaf=leaf, shape=shape):
+            template = DjPjTemplate.patch(engine.get_template(leaf).template)
+
+            def operation():
+                context = make_context(context_data(), request(True))
+                template.render_blocks(context, ['target', 'title'])
+            return operation
+        yield ('render_blocks/%s' % shape.name, render_blocks_setup)
+
+    shape = SHAPES[2]
+
+    def template_resolution_setup():
+        template_view = pjax_template()(view)
+
+        def operation():
+            response = template_view(request(True), shape.leaf)
+            response.resolve_template(response.template_name)
+        return operation
+    yield ('pjax_template/resolve', template_resolution_setup)
+
+    def middleware_setup(pjax, matching):
+        def setup():
+            config = [('^/section%d/' % i, '@pjax_block(title_block="title")')
+                      for i in range(PATTERN_COUNT)]
+            middleware = DjangoPJAXMiddleware(config)
+            path = '/section%d/page/' % (PATTERN_COUNT - 1) if matching \
+                else '/elsewhere/'
+            extra = {'HTTP_X_PJAX': True, 'HTTP_X_PJAX_CONTAINER': '#target'} \
+                if pjax else {}
+
+            def operation():
+                req = rf.get(path, **extra)
+                middleware.process_template_response(
+                    req, TemplateResponse(req, shape.leaf))
+            return operation
+        return setup
+    for pjax in (False, True):
+        for matching in (False, True):
+            yield ('middleware/%s-%s' % ('pjax' if pjax else 'regular',
+                                         'match' if matching else 'miss'),
+                   middleware_setup(pjax, matching))
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure(operation, iterations, warmup):
+    for _ in range(warmup):
+        operation()
+
+    samples = []
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+    samples.sort()
+
+    # Measure allocations separately, since tracing slows everything down.
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(min(iterations, 20)):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            operation()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'p50_us': percentile(samples, 0.5) * 1e6,
+        'p90_us': percentile(samples, 0.9) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'peak_kib': max(peaks) / 1024.0,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print a comparison with the baseline, and return the regressed names."""
+    regressions = []
+    print('\n%-45s %10s %10s %8s' % ('benchmark', 'base p50', 'p50', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['p50_us'], result['p50_us']
+        change = after / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-45s %10.1f %10.1f %+7.1f%%%s'
+              % (name, before, after, change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', '--filter', default='',
+                        help="only run benchmarks matching this regex")
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--save', metavar='FILE',
+                        help="save results as a baseline for later comparison")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare results with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="median slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    setup_django()
+    pattern = re.compile(args.filter)
+    results = {}
+    print('%-45s %10s %10s %10s %10s' % ('benchmark', 'p50 us', 'p90 us',
+                                        'p99 us', 'peak KiB'))
+    for name, setup in benchmarks():
+        if not pattern.search(name):
+            continue
+        result = results[name] = measure(setup(), args.iterations, args.warmup)
+        print('%-45s %10.1f %10.1f %10.1f %10.1f'
+              % (name, result['p50_us'], result['p90_us'], result['p99_us'],
+                 result['peak_kib']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,7 @@
+import django
+
 from djpj.decorator import pjax_block, pjax_template
+
+# Django 3.2 finds the app's configuration by itself.
+if django.VERSION < (3, 2):
+    default_app_config = 'djpj.apps.DjPjConfig'
@@ -0,0 +1,138 @@
+"""
+Support for serving PJAX responses from async views and under ASGI. This
+module uses async syntax, so it's only imported once an async view or async
+middleware chain is found.
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync, sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.template.response import SimpleTemplateResponse
+
+from djpj.compat import iscoroutinefunction
+from djpj.instrumentation import clock
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def render_executor():
+    """
+    Return the thread pool which renders templates for async views, creating
+    it the first time. Its size is the DJPJ_RENDER_THREADS setting.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'DJPJ_RENDER_THREADS', 4),
+                    thread_name_prefix='djpj-render')
+    return _executor
+
+
+def _render(response):
+    try:
+        return response.render()
+    finally:
+        # Like the request_finished signal, but for this worker thread's
+        # own database connections.
+        close_old_connections()
+
+
+def defer_render(request, response):
+    """
+    Give an unrendered template response an async render() method, which
+    Django's async handler awaits in place of running render() on its thread
+    for synchronous code. Templates are rendered in the render_executor()
+    pool, but a response that won't render any, such as a fragment found in
+    pjax_block's cache, is rendered directly on the event loop.
+
+    Only responses to requests from Django's ASGI handler are changed, as
+    its synchronous handler, which also serves async views, expects render()
+    to be synchronous.
+    """
+    if (not isinstance(request, ASGIRequest) or
+            not isinstance(response, SimpleTemplateResponse) or
+            response.is_rendered):
+        return response
+
+    async def render():
+        # Restore the class's render(), which _render calls.
+        del response.render
+        if response.is_rendered or (hasattr(response, 'renders_from_cache')
+                                    and response.renders_from_cache()):
+            return response.render()
+        return await SyncToAsync(_render, thread_sensitive=False,
+                                 executor=render_executor())(response)
+
+    response.render = render
+    return response
+
+
+def mark_coroutine_function(obj):
+    """Mark obj as a coroutine function, as Django's checks see it."""
+    try:
+        from asgiref.sync import markcoroutinefunction
+    except ImportError:
+        import asyncio
+        obj._is_coroutine = asyncio.coroutines._is_coroutine
+        return obj
+    return markcoroutinefunction(obj)
+
+
+async def _call(fn, *args):
+    if iscoroutinefunction(fn):
+        return await fn(*args)
+    return await sync_to_async(fn)(*args)
+
+
+async def process_response(decorator, request, response, endpoint=None):
+    """
+    Process a response as decorator.process_response does, awaiting the
+    decorator's ETag function if it's a coroutine function. That's done on
+    the event loop, unless it may block - loading templates for
+    DJPJ_PJAX_VERSION, following a redirect or rendering the start of a
+    streaming response - in which case it runs in Django's thread for
+    synchronous code.
+    """
+    args = (request, response, endpoint)
+    etag_function = decorator.etag_function(request, response)
+    if etag_function is not None:
+        args += (await _call(etag_function, request),)
+    if decorator.may_block(request, response):
+        return await sync_to_async(decorator.process_response)(*args)
+    return decorator.process_response(*args)
+
+
+def wrap_view(view, decorator, endpoint, count_request):
+    """Wrap an async view as djpj_decorator wraps a synchronous one."""
+
+    @functools.wraps(view)
+    async def wrapped_view(request, *args, **kwargs):
+        count_request(request)
+        response = await view(request, *args, **kwargs)
+        response = await process_response(decorator, request, response,
+                                          endpoint)
+        return defer_render(request, response)
+    wrapped_view.djpj_decorated = True
+    return wrapped_view
+
+
+async def process_template_response(middleware, request, response):
+    """
+    DjangoPJAXMiddleware.process_template_response, for an async middleware
+    chain.
+    """
+    start = clock()
+    skips = middleware.skips(request, response)
+    for endpoint, decorator in middleware.matching_decorators(request):
+        if not (skips and decorator.only_varies(request)):
+            response = await process_response(decorator, request, response,
+                                              endpoint)
+    middleware.record_dispatch(response, start)
+    return defer_render(request, response)
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class DjPjConfig(AppConfig):
+    name = 'djpj'
+    verbose_name = 'DjPj'
+
+    def ready(self):
+        # Warm up every process that loads the app, so that configuration
+        # errors stop it from starting rather than failing its requests.
+        if getattr(settings, 'DJPJ_WARMUP', False):
+            from djpj.warmup import warm_up
+            warm_up()
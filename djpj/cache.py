@@ -0,0 +1,141 @@
+import copy
+import hashlib
+
+from django.conf import settings
+
+from djpj.compat import string_types
+from djpj.utils import LRUCache
+
+# The headers that make a request a PJAX request, which the ordinary request
+# for a page doesn't have.
+_pjax_request_headers = ('HTTP_X_PJAX', 'HTTP_X_PJAX_CONTAINER',
+                         'HTTP_X_DJPJ_CONTAINERS', 'HTTP_X_DJPJ_LAZY')
+
+
+class FragmentCache(object):
+    """
+    The interface for caches of rendered PJAX fragments, which can be passed
+    to pjax_block as its cache argument.
+    """
+
+    def get(self, key):
+        """Return the fragment stored under key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, fragment):
+        """Store a fragment under key."""
+        raise NotImplementedError
+
+
+class DjangoFragmentCache(FragmentCache):
+    """
+    Stores fragments in one of the caches configured in Django's CACHES
+    setting, with the cache's default timeout unless another is given.
+    """
+
+    def __init__(self, alias='default', timeout=None):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        # Fetch the cache on each use, as Django's cache connections are
+        # local to each thread.
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, fragment):
+        if self.timeout is None:
+            self.cache.set(key, fragment)
+        else:
+            self.cache.set(key, fragment, self.timeout)
+
+
+class LocalFragmentCache(FragmentCache):
+    """
+    Stores up to maxsize fragments in process memory, discarding the least
+    recently used first. Fragments expire timeout seconds after being stored,
+    or never if timeout is None.
+    """
+
+    def __init__(self, maxsize=1000, timeout=300):
+        self._cache = LRUCache(maxsize, timeout)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, fragment):
+        self._cache.set(key, fragment)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def get_fragment_cache(cache):
+    """
+    Return a FragmentCache for the cache argument of pjax_block: either a
+    FragmentCache, or the name of a cache in Django's CACHES setting.
+    """
+    if isinstance(cache, FragmentCache):
+        return cache
+    if isinstance(cache, string_types):
+        return DjangoFragmentCache(cache)
+    raise ValueError("PJAX fragment cache must be a FragmentCache or "
+                     "the name of a Django cache, not %r" % (cache,))
+
+
+def fragment_cache_key(template_name, block, title_block, title_variable,
+                       user_key):
+    """
+    Return a cache key for a rendered fragment, or None if the template name
+    isn't a template path or a sequence of them, and so can't be keyed.
+    """
+    return _cache_key('djpj.fragment', template_name,
+                      (block, title_block, title_variable, user_key))
+
+
+def page_cache_key(template_name, content):
+    """
+    Return a cache key for the block offsets of a rendered page, given as
+    bytes, whose blocks' fragments can be sliced out of it, or None as for
+    fragment_cache_key.
+    """
+    return _cache_key('djpj.page', template_name,
+                      (hashlib.md5(content).hexdigest(),))
+
+
+def cached_page(request):
+    """
+    Return the content and charset of the page that Django's cache middleware
+    has cached for a PJAX request's URL, as if it were an ordinary request,
+    or None if there's no such page or it's been encoded.
+    """
+    from django.core.cache import caches
+    from django.utils.cache import get_cache_key
+
+    page_request = copy.copy(request)
+    page_request.META = dict((key, value) for key, value
+                             in request.META.items()
+                             if key not in _pjax_request_headers)
+    cache = caches[settings.CACHE_MIDDLEWARE_ALIAS]
+    key = get_cache_key(page_request, settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+                        'GET', cache=cache)
+    response = cache.get(key) if key else None
+    if (response is None or getattr(response, 'streaming', False) or
+            response.has_header('Content-Encoding')):
+        return None
+    return response.content, response.charset
+
+
+def _cache_key(prefix, template_name, parts):
+    if isinstance(template_name, (list, tuple)):
+        names = tuple(template_name)
+    else:
+        names = (template_name,)
+    if not all(isinstance(n, string_types) for n in names):
+        return None
+    digest = hashlib.md5(repr(names + parts).encode('utf-8')).hexdigest()
+    return '%s.%s' % (prefix, digest)
@@ -0,0 +1,69 @@
+import logging
+import threading
+
+logger = logging.getLogger('djpj')
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight,
+    other threads calling with its key wait for it to finish, and share its
+    result or exception instead of making the call themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, fn, timeout=None):
+        """
+        Return a pair of fn() (or the result of the call in flight with the
+        same key) and whether that result was shared with another call. If the
+        call in flight takes longer than timeout seconds, stop waiting for it
+        and call fn() anyway.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            if call.done.wait(timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            logger.debug("Gave up waiting for in-flight render %s after %ss",
+                         key, timeout)
+            return fn(), False
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def waiters(self, key):
+        """Return the number of calls waiting for the call with this key."""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call is not None else 0
+
+
+# The renders of PJAX fragments in flight in this process.
+in_flight = SingleFlight()
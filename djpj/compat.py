@@ -6,3 +6,55 @@ if PY2:
     import Queue as queue
 else:
     import queue
+
+if PY2:
+    string_types = basestring  # noqa
+else:
+    string_types = str
+
+if PY2:
+    from django.utils.encoding import force_text
+else:
+    from django.utils.encoding import force_str as force_text
+
+try:
+    from asyncio import iscoroutinefunction
+except ImportError:  # Python 2
+    def iscoroutinefunction(fn):
+        return False
+
+if PY2:
+    from urllib import unquote
+    from urlparse import urljoin, urlsplit
+else:
+    from urllib.parse import unquote, urljoin, urlsplit
+
+try:
+    from django.utils.encoding import force_bytes
+except ImportError:  # Django < 1.5
+    from django.utils.encoding import smart_str as force_bytes
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:  # Django < 1.5, whose responses stream iterators anyway
+    from django.http import HttpResponse as StreamingHttpResponse
+
+try:
+    from django.utils.html import format_html
+except ImportError:  # Django < 1.5
+    from django.utils.html import conditional_escape
+    from django.utils.safestring import mark_safe
+
+    def format_html(format_string, *args):
+        return mark_safe(format_string.format(
+            *[conditional_escape(arg) for arg in args]))
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed
+
+try:
+    from django.http.response import HttpResponseRedirectBase
+except ImportError:  # Django < 1.5
+    from django.http import HttpResponseRedirectBase
@@ -1,12 +1,31 @@
 import functools
+import hashlib
 
-from django.http import HttpResponseRedirect, HttpRequest
-from djpj.template import PJAXTemplateResponse
-from djpj.utils import (strip_pjax_parameter, is_pjax,
-                        pjax_container, pjaxify_template_var_with_container)
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, HttpRequest
+from django.template.response import SimpleTemplateResponse
+from django.utils.http import parse_etags, quote_etag
 
+from djpj.cache import get_fragment_cache
+from djpj.compat import (HttpResponseRedirectBase, iscoroutinefunction,
+                         string_types)
+from djpj.dispatch import follow_redirect, redirect_to_follow
+from djpj.instrumentation import instrumentation_enabled
+from djpj.metrics import count_request, metrics_enabled
+from djpj.template import PJAXTemplateResponse, layout_version
+from djpj.utils import (strip_pjax_parameter, is_pjax, pjax_containers,
+                        pjax_lazy_block, pjaxify_template_var_with_container)
 
-def _make_decorator(partition_fn, process_fn):
+
+# Distinguishes an ETag version not yet computed from one that's None.
+_unknown = object()
+
+# The request headers that decide which fragments a PJAX response holds.
+_vary_headers = ('X-PJAX-Container', 'X-DjPj-Containers', 'X-DjPj-Lazy')
+
+
+def _make_decorator(partition_fn, process_fn, etag=None, other_fn=None,
+                    blocking=False):
     """
     Produce a DjPj decorator function suitable for decorating a Django view
     that returns TemplateResponse. Used by pjax_block and pjax_template.
@@ -14,43 +33,275 @@ def _make_decorator(partition_fn, process_fn):
     The behaviour of the resultant decorator is this: wherever
     partition_fn(request) is True and the decorated view returned a
     TemplateResponse, process_fn will be called with the request and response
-    as its arguments and the result returned in place of the original response.
+    as its arguments. If it returns a response, that is returned in place of
+    the original response. If other_fn is given, it's called in the same way
+    for the TemplateResponses to every other request.
+
+    The decorator's process_response attribute applies the same processing to
+    a response directly, without decorating a view. DjangoPJAXMiddleware uses
+    this to avoid building a new view wrapper for every response. It takes
+    the name of the endpoint to record in the response's metrics, which for
+    decorated views is the view's import path. Its only_varies attribute
+    tells whether, for a request, process_response would do no more than add
+    to the response's Vary header, and its may_block attribute whether, for
+    a request and response, it may block: loading templates, following a
+    redirect, or in process_fn if blocking is True.
+
+    While DjPj's instrumentation is enabled, responses are patched so that
+    their rendering is measured even where process_fn doesn't patch them.
+
+    Async views are wrapped with an async view; see djpj.aio.
+
+    Redirects are followed on the server where DJPJ_FOLLOW_REDIRECTS allows;
+    see djpj.dispatch.redirect_to_follow.
+
+    If etag is True, processed responses are given an ETag computed from their
+    rendered content. If it's a callable, or the import path of one, the ETag
+    is instead computed from etag(request) before anything is rendered. Either
+    way, a 304 response is returned if the request's If-None-Match matches.
+    Only 200 responses to GET and HEAD requests are given ETags.
     """
 
     # Import this here to avoid import issues when running tests.
-    from django.views.decorators.vary import vary_on_headers
+    from django.utils.cache import patch_vary_headers
+
+    def etag_function(request, response):
+        # The function computing the response's ETag version, if it needs one.
+        if (etag and etag is not True and _is_conditional(request, response)
+                and partition_fn(request) and _is_renderable(response)):
+            return _resolve_callable(etag)
+        return None
+
+    def process_response(request, response, endpoint=None,
+                         etag_version=_unknown):
+        if partition_fn(request):
+            # Where DJPJ_FOLLOW_REDIRECTS allows, answer with the response of
+            # the redirect's target instead, sparing the client a request.
+            url = redirect_to_follow(request, response)
+            followed = url and follow_redirect(request, url, response)
+            if followed is not None:
+                patch_vary_headers(followed, _vary_headers)
+                return followed
+
+            # Before generating a response, strip the "_pjax" GET parameter
+            # that jquery-pjax adds as a browser cache-busting measure.
+            strip_pjax_parameter(request)
+
+            # This header helps jquery-pjax correctly handle redirects.
+            response['X-PJAX-URL'] = (response.get('Location')
+                                      or request.get_full_path())
+            # Test if response supports deferred rendering, approach copied
+            # from django.core.handlers.base.BaseHandler.get_response()
+            if _is_renderable(response):
+                version = _pjax_version(response)
+                if version is not None:
+                    response['X-PJAX-Version'] = version
+                if _version_changed(request, version):
+                    response = _layout_changed(response)
+                elif etag is True and _is_conditional(request, response):
+                    response.add_post_render_callback(
+                        functools.partial(_check_content_etag, request))
+                elif etag and _is_conditional(request, response):
+                    if etag_version is _unknown:
+                        etag_version = _resolve_callable(etag)(request)
+                    response['ETag'] = _fragment_etag(request, etag_version)
+                    if _etag_matches(request, response['ETag']):
+                        response = _not_modified(response)
+                if _is_renderable(response):
+                    response = process_fn(request, response) or response
+            elif not _passes_through(response):
+                raise TypeError("PJAX views must return either a response "
+                                "with a render() method, or a redirect.")
+        elif other_fn is not None and _is_renderable(response):
+            response = other_fn(request, response) or response
+        if (isinstance(response, SimpleTemplateResponse) and
+                not isinstance(response, PJAXTemplateResponse) and
+                not response.is_rendered and instrumentation_enabled()):
+            PJAXTemplateResponse.patch(response, None, None, None)
+        stats = getattr(response, 'djpj_stats', None)
+        if stats is not None and endpoint:
+            stats.endpoint = endpoint
+        patch_vary_headers(response, _vary_headers)
+        return response
 
     def djpj_decorator(view):
+        endpoint = '%s.%s' % (view.__module__, getattr(view, '__qualname__',
+                                                       view.__name__))
+
+        def count(request):
+            if metrics_enabled():
+                count_request(endpoint, partition_fn(request))
+
+        if iscoroutinefunction(view):
+            from djpj.aio import wrap_view
+            return wrap_view(view, djpj_decorator, endpoint, count)
+
         @functools.wraps(view)
         def wrapped_view(request, *args, **kwargs):
-            response = view(request, *args, **kwargs)
-            if partition_fn(request):
-                # Before generating a response, strip the "_pjax" GET parameter
-                # that jquery-pjax adds as a browser cache-busting measure.
-                strip_pjax_parameter(request)
-
-                # This header helps jquery-pjax correctly handle redirects.
-                response['X-PJAX-URL'] = (response.get('Location')
-                                          or request.get_full_path())
-                # Test if response supports deferred rendering, approach copied
-                # from django.core.handlers.base.BaseHandler.get_response()
-                if hasattr(response, 'render') and callable(response.render):
-                    process_fn(request, response)
-                elif not isinstance(response, HttpResponseRedirect):
-                    raise TypeError("PJAX views must return either a response "
-                                    "with a render() method, or a redirect.")
-            return response
-        return vary_on_headers('X-PJAX-Container')(wrapped_view)
+            count(request)
+            return process_response(request, view(request, *args, **kwargs),
+                                    endpoint)
+        wrapped_view.djpj_decorated = True
+        return wrapped_view
+
+    def only_varies(request):
+        # Whether process_response would only add the Vary header.
+        return (not partition_fn(request) and other_fn is None and
+                not instrumentation_enabled())
+
+    def may_block(request, response):
+        # Whether process_response may do blocking work, which async callers
+        # leave the event loop for.
+        if not partition_fn(request):
+            return False
+        if redirect_to_follow(request, response) is not None:
+            return True
+        return _is_renderable(response) and (
+            blocking or getattr(settings, 'DJPJ_PJAX_VERSION', False))
 
+    djpj_decorator.may_block = may_block
+    djpj_decorator.etag_function = etag_function
+    djpj_decorator.only_varies = only_varies
+    djpj_decorator.process_response = process_response
     return djpj_decorator
 
+
+def _is_renderable(response):
+    # Responses DjPj answers with in place of a view's, like
+    # NotModifiedPJAXResponse, have render() methods but are complete.
+    return (hasattr(response, 'render') and callable(response.render) and
+            not getattr(response, 'is_rendered', False))
+
+
+def _passes_through(response):
+    # Responses that PJAX views may return besides renderable ones, including
+    # those an inner DjPj decorator answered with.
+    return (isinstance(response, (HttpResponseRedirectBase,
+                                  HttpResponseNotModified)) or
+            getattr(response, 'is_rendered', False))
+
+
+def _is_conditional(request, response):
+    # As with ConditionalGetMiddleware, only successful responses to GET and
+    # HEAD requests are given ETags, so that errors don't become 304s.
+    return (request.method in ('GET', 'HEAD') and
+            response.status_code == 200)
+
+
+def _fragment_etag(request, *parts):
+    # Include the containers, so that each container's fragment of the same
+    # page gets its own ETag.
+    parts = tuple(request.META.get('HTTP_' + h.upper().replace('-', '_'), '')
+                  for h in _vary_headers) + parts
+    digest = hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+    return quote_etag(digest)
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    return bool(if_none_match) and (if_none_match.strip() == '*' or
+                                    etag in parse_etags(if_none_match))
+
+
+class NotModifiedPJAXResponse(HttpResponseNotModified):
+    """
+    A 304 response, returned in place of a view's response when a PJAX
+    request's If-None-Match header matches its ETag. It provides a render()
+    method for the same reason as StreamingPJAXResponse.
+    """
+
+    is_rendered = True
+
+    def render(self):
+        return self
+
+
+def _not_modified(response):
+    """Return a 304 response carrying the given response's cache headers."""
+    not_modified = NotModifiedPJAXResponse()
+    for header in ('ETag', 'Vary', 'Cache-Control', 'Expires', 'X-PJAX-URL',
+                   'X-PJAX-Version'):
+        if response.has_header(header):
+            not_modified[header] = response[header]
+    return not_modified
+
+
+def _pjax_version(response):
+    """
+    With the DJPJ_PJAX_VERSION setting, return the layout version of a
+    template response's template, or None. That's the template the view
+    chose, even if pjax_template has since replaced it.
+    """
+    if (not getattr(settings, 'DJPJ_PJAX_VERSION', False) or
+            not isinstance(response, SimpleTemplateResponse)):
+        return None
+    template = response.resolve_template(
+        getattr(response, 'djpj_page_template', response.template_name))
+    # Django >= 1.8 wraps templates in a backend's Template.
+    template = getattr(template, 'template', template)
+    context_data = response.context_data
+    return layout_version(template, context_data
+                          if isinstance(context_data, dict) else None)
+
+
+def _version_changed(request, version):
+    # DjPj's client script sends the version of the page it's showing.
+    client_version = request.META.get('HTTP_X_PJAX_VERSION')
+    return (version is not None and client_version is not None and
+            client_version != version)
+
+
+class LayoutChangedPJAXResponse(HttpResponse):
+    """
+    An empty response, returned in place of a view's response when a PJAX
+    request was made from a page with another layout version. It provides a
+    render() method for the same reason as StreamingPJAXResponse.
+    """
+
+    is_rendered = True
+
+    def render(self):
+        return self
+
+
+def _layout_changed(response):
+    """
+    Return an empty response carrying the given response's X-PJAX-Version
+    header, for jquery-pjax to see that the layout changed and reload the
+    page, without rendering a fragment it would discard.
+    """
+    changed = LayoutChangedPJAXResponse()
+    for header in ('X-PJAX-Version', 'X-PJAX-URL', 'Vary'):
+        if response.has_header(header):
+            changed[header] = response[header]
+    # Clients showing the current layout mustn't be sent this from a cache.
+    changed['Cache-Control'] = 'no-store'
+    return changed
+
+
+def _check_content_etag(request, response):
+    # A post-render callback, which can replace the rendered response.
+    response['ETag'] = _fragment_etag(request, response.content)
+    if _etag_matches(request, response['ETag']):
+        from django.utils.cache import patch_vary_headers
+        patch_vary_headers(response, _vary_headers)
+        return _not_modified(response)
+
+
+def _resolve_callable(fn):
+    """Return fn, or if it's a string, the callable at that import path."""
+    if isinstance(fn, string_types):
+        from django.utils.module_loading import import_string
+        return import_string(fn)
+    return fn
+
 _make_pjax_decorator = functools.partial(_make_decorator, is_pjax)
 
 # So far unused
 _make_ajax_decorator = functools.partial(_make_decorator, HttpRequest.is_ajax)
 
 
-def pjax_template(template=pjaxify_template_var_with_container):
+def pjax_template(template=pjaxify_template_var_with_container, etag=None):
     """
     A view decorator that, for PJAX requests, can search for PJAX-specific
     templates to render. The template argument should be a function that
@@ -59,7 +310,10 @@ def pjax_template(template=pjaxify_template_var_with_container):
 
     By default, with a template like "product.html" and a PJAX request for the
     container "content", "product-pjax=content.html" will be prepended to the
-    list of templates to search for.
+    list of templates to search for. Names found not to exist are remembered
+    and skipped; see djpj.utils.select_existing_template.
+
+    See pjax_block for the etag argument.
     """
 
     if not template:
@@ -72,12 +326,20 @@ def pjax_template(template=pjaxify_template_var_with_container):
         if not _template:
             raise ValueError("Tried to set PJAX response's template to %s. "
                              "You must provide a template!" % _template)
+        # Layout versions are computed from the page's own template.
+        if not hasattr(response, 'djpj_page_template'):
+            response.djpj_page_template = response.template_name
         response.template_name = _template
+        # Have the response skip PJAX templates already found not to exist.
+        if isinstance(response, SimpleTemplateResponse):
+            PJAXTemplateResponse.patch(response, None, None, None)
 
-    return _make_pjax_decorator(process_response)
+    return _make_pjax_decorator(process_response, etag)
 
 
-def pjax_block(block=pjax_container, title_variable=None, title_block=None):
+def pjax_block(block=pjax_containers, title_variable=None, title_block=None,
+               cache=None, cache_key=None, etag=None, stream=False,
+               context_processors=None, coalesce=None, slice_pages=False):
     """
     A view decorator that, for PJAX requests, can return the contents of a
     single template block to the client instead of the whole page.
@@ -86,8 +348,49 @@ def pjax_block(block=pjax_container, title_variable=None, title_block=None):
     returned. If it's a callable, the result of calling block(request) will be
     the name of the rendered block.
 
+    If block is, or returns, a list of block names, every block is rendered in
+    a single pass and returned in a multi-fragment response, which can be
+    split with djpj.utils.split_fragments or DjPj's client script. By default
+    that happens when the request has an X-DjPj-Containers header.
+
     title_variable and title_block can't both be passed, and determine the
     contents of the response's <title> tag.
+
+    If cache is passed - either a djpj.cache.FragmentCache or the name of a
+    Django cache - rendered fragments are cached, keyed on the template name,
+    block and title, and the result of cache_key(request). cache_key may be
+    a callable or its dotted import path, and is required with cache.
+
+    If etag is True, responses get an ETag computed from the rendered
+    fragment. If it's a callable, or its dotted import path, the ETag is
+    computed from etag(request) instead, so that requests whose If-None-Match
+    header matches can be answered with a 304 without rendering at all.
+
+    If stream is True, a streaming response is returned which sends the
+    <title> tag as soon as it's rendered, followed by the block's content
+    piece by piece. See PJAXTemplateResponse.iter_rendered_content().
+
+    By default, PJAX responses run every context processor configured for the
+    template engine. If context_processors is a list of processors, or their
+    import paths, only those are run, besides Django's built-in CSRF
+    processor; pass an empty list to run none. If it's "auto", processors are
+    run only until they're known to provide no variable the blocks use.
+
+    If coalesce is passed, concurrent renders of the same fragment are
+    coalesced into one, whose result every response shares. It's a callable,
+    or its dotted import path, that takes a request and returns a key which,
+    with the template, block and title, identifies the fragment - or None if
+    the request's fragment shouldn't be shared. A response waits up to
+    DJPJ_COALESCE_TIMEOUT seconds (10 by default) before rendering its own.
+
+    Whatever block is given, a request with an X-DjPj-Lazy header is answered
+    with the block it names, without a title, to fill in the placeholder of a
+    {% pjax_lazy %} block.
+
+    If slice_pages is True, where each block's output is in the whole pages
+    rendered for other requests is stored in the cache too. A PJAX request
+    whose page has been cached by Django's cache middleware is then answered
+    with its blocks sliced out of the page, without rendering anything.
     """
     if not block:
         raise ValueError("The block argument to pjax_block may not be None.")
@@ -96,9 +399,50 @@ def pjax_block(block=pjax_container, title_variable=None, title_block=None):
         raise ValueError("Only one of 'title_variable' and 'title_block' "
                          "may be passed to pjax decorator.")
 
+    if cache and not cache_key:
+        raise ValueError("A cache_key function must be passed to pjax_block "
+                         "along with a cache.")
+    if slice_pages and not cache:
+        raise ValueError("A cache must be passed to pjax_block along with "
+                         "slice_pages.")
+    fragment_cache = get_fragment_cache(cache) if cache else None
+
+    if not (context_processors is None or context_processors == 'auto' or
+            isinstance(context_processors, (list, tuple))):
+        raise ValueError("context_processors must be a list of context "
+                         "processors, or 'auto'.")
+
+    if stream and etag is True:
+        raise ValueError("ETags can't be computed from the content of "
+                         "streaming responses; pass a function as etag.")
+
     def process_response(request, response):
-        _block = block(request) if callable(block) else block
+        # A {% pjax_lazy %} block is filled in without touching the title.
+        lazy_block = pjax_lazy_block(request)
+        if lazy_block:
+            _block, _title_block, _title_variable = lazy_block, None, None
+        else:
+            _block = block(request) if callable(block) else block
+            _title_block, _title_variable = title_block, title_variable
+        if isinstance(_block, (list, tuple)):
+            response['X-DjPj-Fragments'] = ','.join(_block)
+        _cache_key = _resolve_callable(cache_key) if cache else None
+        _coalesce = _resolve_callable(coalesce) if coalesce else None
         PJAXTemplateResponse.patch(response, _block,
-                                  title_block, title_variable)
+                                  _title_block, _title_variable,
+                                  fragment_cache, _cache_key,
+                                  context_processors, _coalesce, slice_pages)
+        if stream:
+            return response.streaming_response()
+
+    def process_page_response(request, response):
+        if isinstance(response, SimpleTemplateResponse):
+            PJAXTemplateResponse.patch(response, None, title_block,
+                                       title_variable, fragment_cache,
+                                       _resolve_callable(cache_key),
+                                       slice_pages=True)
 
-    return _make_pjax_decorator(process_response)
+    # Streaming responses render their title before they're returned.
+    return _make_pjax_decorator(process_response, etag,
+                                process_page_response if slice_pages else None,
+                                blocking=stream)
@@ -0,0 +1,256 @@
+"""
+Dispatching requests to views from within another request. Used by the batch
+view, and to follow redirects on the server.
+"""
+import copy
+import threading
+
+from django.conf import settings
+from django.http import Http404, HttpRequest, HttpResponse, QueryDict
+from django.utils.datastructures import MultiValueDict
+
+from djpj.compat import (HttpResponseRedirectBase, iscoroutinefunction,
+                         setting_changed, unquote, urljoin, urlsplit)
+from djpj.template import DjPjObject
+from djpj.utils import pjax_container
+
+try:
+    from django.urls import (get_script_prefix, get_urlconf, resolve,
+                             set_urlconf)
+except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import (get_script_prefix, get_urlconf,
+                                          resolve, set_urlconf)
+
+# Headers that only apply to the request an internal request is copied from.
+_request_only_headers = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE',
+                         'CONTENT_TYPE', 'CONTENT_LENGTH')
+
+# Headers naming what to render, replaced when a container is given.
+_container_headers = ('HTTP_X_DJPJ_CONTAINERS', 'HTTP_X_DJPJ_LAZY')
+
+# Attributes that middleware sets on each request, which internal requests
+# keep from the request they're copied from, so that they see what its view
+# did to them - logging in, or adding messages.
+_shared_attributes = ('session', 'user', '_cached_user', '_messages')
+
+# Headers of a redirect that don't apply to the response it's followed to.
+_redirect_only_headers = ('location', 'content-type', 'content-length', 'vary')
+
+_handler = None
+_pjax_urls_middleware = None
+_handler_lock = threading.Lock()
+
+
+def internal_request(request, url, container=None):
+    """
+    Return a copy of the request, as a GET (or HEAD) request for the given
+    local URL, and if a container is given, a PJAX request for it. Raise
+    ValueError if the URL isn't a local one or the container isn't a valid
+    name.
+
+    The copy shares what the project's middleware set on the request, such
+    as its session and user, and when it's dispatched through the middleware,
+    they aren't replaced; see InternalRequest.
+    """
+    parts = urlsplit(url)
+    if parts.scheme or parts.netloc or not parts.path.startswith('/'):
+        raise ValueError("Internal requests must have local paths, not %r"
+                         % url)
+    excluded = _request_only_headers
+    if container is not None:
+        excluded += _container_headers
+    item = copy.copy(request)
+    item.META = dict((key, value) for key, value in request.META.items()
+                     if key not in excluded)
+    item.META['QUERY_STRING'] = parts.query
+    if container is not None:
+        item.META.update(HTTP_X_PJAX='true',
+                         HTTP_X_PJAX_CONTAINER='#%s' % container.lstrip('#'))
+        pjax_container(item)
+
+    item.method = 'HEAD' if request.method == 'HEAD' else 'GET'
+    item.META['REQUEST_METHOD'] = item.method
+    item.path = unquote(parts.path)
+    prefix = get_script_prefix()
+    if item.path.startswith(prefix):
+        item.path_info = '/' + item.path[len(prefix):]
+    else:
+        item.path_info = item.path
+    item.META['PATH_INFO'] = item.path_info
+    item.GET = QueryDict(parts.query)
+    item.POST, item._files = QueryDict(), MultiValueDict()
+    item.resolver_match = None
+    return InternalRequest.patch(item)
+
+
+class InternalRequest(DjPjObject, HttpRequest):
+    """
+    Requests made by internal_request() are patched with this class, so that
+    the project's middleware can't replace the session, user and messages
+    they share with the request they were copied from.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        # Internal requests are copied in turn to follow further redirects.
+        return object.__new__(cls)
+
+    def __setattr__(self, name, value):
+        if name in _shared_attributes and name in self.__dict__:
+            return
+        super(InternalRequest, self).__setattr__(name, value)
+
+
+def dispatch(request, djpj_only=False):
+    """
+    Pass a request made by internal_request() through the project's
+    middleware to its view, and return the rendered response, as Django's
+    request handler would. Exceptions raised by the view, such as Http404,
+    are turned into responses the same way.
+
+    If djpj_only is True, return None instead of calling a view that isn't
+    decorated with pjax_block or pjax_template. Paths that don't resolve to
+    a view raise Http404.
+    """
+    if djpj_only:
+        match = resolve(request.path_info, getattr(request, 'urlconf', None))
+        if not getattr(match.func, 'djpj_decorated', False):
+            return None
+    urlconf = get_urlconf()
+    try:
+        return _request_handler().get_response(request)
+    finally:
+        # The handler sets the thread's URLconf for the request it handles.
+        set_urlconf(urlconf)
+
+
+def call_view(request):
+    """
+    Call the view of a request made by internal_request() directly, without
+    the project's middleware, and return its rendered response, or None if
+    the view isn't decorated with pjax_block or pjax_template and its URL
+    isn't matched by DJPJ_PJAX_URLS. Paths that don't resolve to a view raise
+    Http404, and exceptions raised by the view are raised.
+
+    Views matched by DJPJ_PJAX_URLS are served as DjangoPJAXMiddleware would.
+    """
+    match = resolve(request.path_info, getattr(request, 'urlconf', None))
+    middleware = None
+    if not getattr(match.func, 'djpj_decorated', False):
+        middleware = _pjax_urls()
+        if not middleware.dispatcher.match(request.path):
+            return None
+        middleware.process_request(request)
+    request.resolver_match = match
+
+    view = match.func
+    if iscoroutinefunction(view):
+        from asgiref.sync import async_to_sync
+        view = async_to_sync(view)
+    response = view(request, *match.args, **match.kwargs)
+    if hasattr(response, 'render') and callable(response.render):
+        if middleware is not None:
+            response = middleware.process_template_response(request, response)
+        response = response.render()
+    return response
+
+
+def _pjax_urls():
+    # A DjangoPJAXMiddleware reading DJPJ_PJAX_URLS, for call_view() to
+    # process the responses of the views it matches.
+    global _pjax_urls_middleware
+    if _pjax_urls_middleware is None:
+        with _handler_lock:
+            if _pjax_urls_middleware is None:
+                from djpj.middleware import DjangoPJAXMiddleware
+                _pjax_urls_middleware = DjangoPJAXMiddleware()
+    return _pjax_urls_middleware
+
+
+def _request_handler():
+    # A handler with the project's middleware loaded, shared by internal
+    # requests as Django's own handlers are by the requests they serve.
+    global _handler
+    if _handler is None:
+        with _handler_lock:
+            if _handler is None:
+                from django.core.handlers.base import BaseHandler
+                handler = BaseHandler()
+                handler.load_middleware()
+                _handler = handler
+    return _handler
+
+
+def _forget_handler(setting, **kwargs):
+    global _handler, _pjax_urls_middleware
+    if setting in ('MIDDLEWARE', 'MIDDLEWARE_CLASSES'):
+        _handler = None
+    elif setting == 'DJPJ_PJAX_URLS':
+        _pjax_urls_middleware = None
+
+setting_changed.connect(_forget_handler)
+
+
+def redirect_to_follow(request, response):
+    """
+    Return the local URL that a response to a PJAX request redirects to, if
+    the DJPJ_FOLLOW_REDIRECTS setting allows following the redirect on the
+    server, or None.
+
+    DJPJ_FOLLOW_REDIRECTS is the number of redirects to follow in a row, and
+    is 0 by default. Redirects are only followed to the same host and scheme,
+    and redirects that preserve the request's method (307 and 308) only for
+    GET and HEAD requests.
+    """
+    limit = getattr(settings, 'DJPJ_FOLLOW_REDIRECTS', 0)
+    if (not limit or not isinstance(response, HttpResponseRedirectBase) or
+            getattr(request, 'djpj_redirects', 0) >= limit):
+        return None
+    if (response.status_code in (307, 308) and
+            request.method not in ('GET', 'HEAD')):
+        return None
+    target = urlsplit(urljoin(request.build_absolute_uri(),
+                              response['Location']))
+    if (target.scheme != request.scheme or
+            target.netloc != request.get_host()):
+        return None
+    return target.path + ('?' + target.query if target.query else '')
+
+
+def follow_redirect(request, url, redirect):
+    """
+    Dispatch a copy of the request for the URL returned by
+    redirect_to_follow(), and return the rendered response, or None if the
+    URL's view isn't decorated with pjax_block or pjax_template, or its
+    response is an error. The headers and cookies set on the redirect are
+    kept, unless the response sets them too.
+
+    The response is a plain HttpResponse, so that the response middleware of
+    the original request can't process it as the original URL's response.
+    """
+    followed = internal_request(request, url)
+    followed.djpj_redirects = getattr(request, 'djpj_redirects', 0) + 1
+    try:
+        response = dispatch(followed, djpj_only=True)
+    except Http404:
+        return None
+    if response is None or response.status_code >= 400:
+        return None
+
+    from django.utils.cache import patch_vary_headers
+
+    if getattr(response, 'streaming', False):
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+    plain = HttpResponse(content, status=response.status_code)
+    for header, value in redirect.items():
+        if header.lower() not in _redirect_only_headers:
+            plain[header] = value
+    for header, value in response.items():
+        plain[header] = value
+    if redirect.has_header('Vary'):
+        patch_vary_headers(plain, [h.strip() for h
+                                   in redirect['Vary'].split(',')])
+    plain.cookies.update(redirect.cookies)
+    plain.cookies.update(response.cookies)
+    return plain
@@ -0,0 +1,133 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from djpj.compat import force_bytes
+from djpj.metrics import metrics_enabled, registry
+from djpj.signals import response_rendered
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def instrumentation_enabled():
+    """
+    Return True if DjPj should measure the responses it processes: when the
+    DJPJ_SERVER_TIMING or DJPJ_METRICS setting is True, or a receiver is
+    connected to the djpj.signals.response_rendered signal.
+    """
+    return (getattr(settings, 'DJPJ_SERVER_TIMING', False) or
+            metrics_enabled() or response_rendered.has_listeners())
+
+
+class RenderStats(object):
+    """
+    Measurements taken while DjPj processed and rendered a single response.
+
+    mode is how the response was rendered: "full" for a whole page, "template"
+    for a PJAX-specific template chosen by pjax_template, "cached" for a
+    fragment found in pjax_block's cache, "coalesced" for a fragment shared by
+    an identical render in flight, and otherwise "patched", "unpatched" or
+    "direct" for blocks rendered in the corresponding way.
+
+    timings maps the names of the phases below to the seconds spent in them,
+    in the order they happened. Phases that didn't happen are absent.
+
+        dispatch  matching the URL and applying decorators in the middleware
+        index     finding the template's blocks and preparing to render them
+        render    rendering the template, or its blocks
+        total     everything done to produce the response's content
+
+    nodes_total is the number of template nodes in the page, and nodes_rendered
+    the number rendered to produce the response. Both are counted from the
+    templates' structure, so loops count once and conditions count every
+    branch, and both are None for full and template renders.
+
+    endpoint names the view or DJPJ_PJAX_URLS pattern that produced the
+    response, cache_hit is True or False if a fragment cache was consulted,
+    error is the name of the exception raised, if rendering failed, and
+    skipped_context lists the context_data keys left out by DJPJ_LAZY_CONTEXT.
+    """
+
+    def __init__(self, blocks=()):
+        self.mode = None
+        self.blocks = tuple(blocks)
+        self.endpoint = None
+        self.timings = OrderedDict()
+        self.stopped_early = False
+        self.nodes_total = None
+        self.nodes_rendered = None
+        self.fragment_size = None
+        self.cache_hit = None
+        self.error = None
+        self.skipped_context = ()
+
+    @property
+    def nodes_skipped(self):
+        if self.nodes_total is None or self.nodes_rendered is None:
+            return None
+        return max(self.nodes_total - self.nodes_rendered, 0)
+
+    @contextmanager
+    def timer(self, phase):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.timings[phase] = (self.timings.get(phase, 0) +
+                                   clock() - start)
+
+    def server_timing(self):
+        """Return a Server-Timing header value reporting these measurements."""
+        description = self.mode or 'unknown'
+        if self.nodes_rendered is not None:
+            description += ' %d/%d nodes' % (self.nodes_rendered,
+                                             self.nodes_total)
+        metrics = ['djpj;desc="%s"' % description]
+        metrics.extend('djpj-%s;dur=%.3f' % (phase, seconds * 1000)
+                       for phase, seconds in self.timings.items())
+        return ', '.join(metrics)
+
+    def add_server_timing(self, response):
+        """Add a Server-Timing header to the response, if configured to."""
+        if getattr(settings, 'DJPJ_SERVER_TIMING', False):
+            existing = response.get('Server-Timing')
+            value = self.server_timing()
+            response['Server-Timing'] = ('%s, %s' % (existing, value)
+                                         if existing else value)
+
+    def finish(self, response, content):
+        """Record the rendered content, then report these measurements."""
+        self.fragment_size = len(force_bytes(content))
+        self.add_server_timing(response)
+        self.send(response)
+
+    def fail(self, response, exception):
+        """Record an exception raised while rendering, and report it."""
+        self.error = type(exception).__name__
+        self.send(response)
+
+    def send(self, response):
+        if metrics_enabled():
+            registry.record_render(self)
+        response_rendered.send(sender=type(response), response=response,
+                               stats=self)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+
+def timer(stats, phase):
+    """
+    Return a context manager which adds the time spent within it to the given
+    phase of stats, or which does nothing if stats is None.
+    """
+    return _null_timer if stats is None else stats.timer(phase)
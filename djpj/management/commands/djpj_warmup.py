@@ -0,0 +1,18 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from djpj.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = ("Compile and index the templates listed in DJPJ_WARMUP_TEMPLATES "
+            "and parse DJPJ_PJAX_URLS, reporting any configuration errors.")
+
+    def handle(self, *args, **options):
+        try:
+            chains = warm_up()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        for chain in chains:
+            self.stdout.write(' -> '.join(chain))
+        self.stdout.write("Warmed up %d template(s)." % len(chains))
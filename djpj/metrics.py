@@ -0,0 +1,168 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+# The metrics DjPj records, as (type, help text, label names, buckets).
+_metric_definitions = OrderedDict([
+    ('djpj_requests_total', (
+        'counter', "Requests handled by DjPj, by endpoint and whether PJAX.",
+        ('endpoint', 'kind'), None)),
+    ('djpj_render_seconds', (
+        'histogram', "Time taken to render responses processed by DjPj.",
+        ('endpoint', 'mode'),
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))),
+    ('djpj_fragment_bytes', (
+        'histogram', "Size of the content of rendered responses.",
+        ('endpoint', 'mode'),
+        (256, 1024, 4096, 16384, 65536, 262144, 1048576))),
+    ('djpj_template_nodes_total', (
+        'counter', "Template nodes in the pages of PJAX responses, by whether "
+                   "they were rendered or skipped.",
+        ('endpoint', 'state'), None)),
+    ('djpj_fragment_cache_total', (
+        'counter', "Lookups in pjax_block's fragment cache, by result.",
+        ('endpoint', 'result'), None)),
+    ('djpj_errors_total', (
+        'counter', "Errors raised while rendering responses, by type.",
+        ('endpoint', 'error'), None)),
+])
+
+
+def metrics_enabled():
+    return getattr(settings, 'DJPJ_METRICS', False)
+
+
+class MetricsRegistry(object):
+    """
+    An in-process store of DjPj's counters and histograms. Each thread updates
+    its own shard of the registry without locking; a lock is only taken to add
+    a thread's shard, and to merge the shards when the metrics are collected.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = dict()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels, amount=1):
+        """Add amount to the counter with the given name and label values."""
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Record a value in the histogram with the given name and labels."""
+        shard = self._shard()
+        key = (name, labels)
+        buckets = _metric_definitions[name][3]
+        histogram = shard.get(key)
+        if histogram is None:
+            # A count for each bucket, then the sum and count of all values.
+            histogram = shard[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self):
+        """
+        Return a dict mapping (name, labels) pairs to the value of a counter,
+        or to a list of per-bucket counts, sum and count for a histogram,
+        merged from every thread's shard.
+        """
+        with self._lock:
+            shards = list(self._shards)
+        merged = dict()
+        for shard in shards:
+            # Copy the shard, since its thread may add keys while we iterate.
+            for key, value in list(shard.items()):
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for i, n in enumerate(value):
+                        total[i] += n
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def clear(self):
+        with self._lock:
+            for shard in self._shards:
+                shard.clear()
+
+    def record_render(self, stats):
+        """Record the measurements of a rendered response's RenderStats."""
+        endpoint = stats.endpoint or ''
+        if stats.error is not None:
+            self.inc('djpj_errors_total', (endpoint, stats.error))
+            return
+        labels = (endpoint, stats.mode or '')
+        if 'total' in stats.timings:
+            self.observe('djpj_render_seconds', labels, stats.timings['total'])
+        if stats.fragment_size is not None:
+            self.observe('djpj_fragment_bytes', labels, stats.fragment_size)
+        if stats.nodes_rendered is not None:
+            self.inc('djpj_template_nodes_total', (endpoint, 'rendered'),
+                     stats.nodes_rendered)
+            self.inc('djpj_template_nodes_total', (endpoint, 'skipped'),
+                     stats.nodes_skipped)
+        if stats.cache_hit is not None:
+            self.inc('djpj_fragment_cache_total',
+                     (endpoint, 'hit' if stats.cache_hit else 'miss'))
+
+    def prometheus_text(self):
+        """Return the collected metrics in Prometheus' text exposition format."""
+        collected = self.collect()
+        lines = []
+        for name, (kind, help_text, label_names, buckets) \
+                in _metric_definitions.items():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (metric, labels), value in sorted(collected.items()):
+                if metric != name:
+                    continue
+                label_text = ','.join('%s="%s"' % (n, _escape_label(v))
+                                      for n, v in zip(label_names, labels))
+                if kind == 'counter':
+                    lines.append('%s{%s} %s' % (name, label_text,
+                                                _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value[:-2]):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d'
+                                 % (name, label_text, bound, cumulative))
+                # Values above the highest bound only appear in the count.
+                lines.append('%s_bucket{%s,le="+Inf"} %d'
+                             % (name, label_text, value[-1]))
+                lines.append('%s_sum{%s} %s' % (name, label_text,
+                                                _format_value(value[-2])))
+                lines.append('%s_count{%s} %d' % (name, label_text, value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+
+def count_request(endpoint, pjax):
+    registry.inc('djpj_requests_total', (endpoint, 'pjax' if pjax else 'full'))
@@ -1,13 +1,87 @@
 import ast
 import re
+import types
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
 # Though IDEs will report these symbols unused, they're necessary
 # to eval() the decorator strings used in DJPJ_PJAX_URLS.
-from djpj.decorator import pjax_block, pjax_template
-from djpj.utils import strip_pjax_parameter
+from djpj.compat import iscoroutinefunction
+from djpj.decorator import _vary_headers, pjax_block, pjax_template
+from djpj.instrumentation import clock
+from djpj.metrics import count_request, metrics_enabled
+from djpj.utils import LRUCache, is_pjax, strip_pjax_parameter
+
+# Backreferences would refer to the wrong groups once patterns are combined.
+_backreference_re = re.compile(r'\\[1-9]|\(\?P=')
+
+
+# The AST node types of literal True, False and None vary by Python version.
+_constant_node_types = tuple(getattr(ast, name) for name
+                             in ('Constant', 'NameConstant') if hasattr(ast, name))
+
+
+def _is_simple_literal(node):
+    if isinstance(node, ast.Str):
+        return True
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return all(isinstance(element, ast.Str) for element in node.elts)
+    if isinstance(node, ast.Name):  # Python 2
+        return node.id in ('True', 'False', 'None')
+    return (isinstance(node, _constant_node_types) and
+            any(node.value is value for value in (True, False, None)))
+
+
+class URLDispatcher(object):
+    """
+    Find which of a sequence of compiled URL regexes match a path, testing
+    all of them with a single regex match where possible, and remembering
+    the results for recently seen paths.
+    """
+
+    def __init__(self, url_regexes, cache_size=1024):
+        self.url_regexes = list(url_regexes)
+        self.combined_regex = self.combine(self.url_regexes)
+        self._cache = LRUCache(cache_size)
+
+    @staticmethod
+    def combine(url_regexes):
+        """
+        Return a regex which always matches, and in doing so sets the group
+        "djpj<i>" wherever url_regexes[i] matches, or None if the regexes
+        can't be combined.
+        """
+        # Each regex becomes a lookahead, so that they're all tested from the
+        # start of the path, with an empty alternative so that failing to
+        # match doesn't stop the others from being tried.
+        for url_regex in url_regexes:
+            if url_regex.flags & ~re.UNICODE or \
+                    _backreference_re.search(url_regex.pattern):
+                return None
+        try:
+            return re.compile(''.join(
+                '(?:(?=(?P<djpj%d>%s))|)' % (i, url_regex.pattern)
+                for i, url_regex in enumerate(url_regexes)))
+        except (re.error, AssertionError, OverflowError):
+            return None
+
+    def match(self, path):
+        """
+        Return a tuple of the indexes of every URL regex matching the path.
+        """
+        indexes = self._cache.get(path)
+        if indexes is None:
+            if self.combined_regex is not None:
+                groups = self.combined_regex.match(path).groupdict()
+                indexes = tuple(i for i in range(len(self.url_regexes))
+                                if groups['djpj%d' % i] is not None)
+            else:
+                indexes = tuple(i for i, url_regex
+                                in enumerate(self.url_regexes)
+                                if url_regex.match(path))
+            self._cache.set(path, indexes)
+        return indexes
 
 
 class DjangoPJAXMiddleware(object):
@@ -15,11 +89,36 @@ class DjangoPJAXMiddleware(object):
     Reads the DjPj configuration found at DJPJ_PJAX_URLS on instantiation, then
     looks for requests that match a configured URL pattern, and runs their
     responses through the decorators configured for that pattern.
+
+    It works as both an old-style middleware (in MIDDLEWARE_CLASSES) and a
+    new-style one (in MIDDLEWARE), and in an async middleware chain under
+    ASGI it processes and renders responses without leaving the event loop
+    except to render templates. See djpj.aio.
     """
 
-    def __init__(self, config=None):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, config=None):
+        # Before new-style middleware, the configuration came first.
+        if get_response is not None and not callable(get_response):
+            get_response, config = None, get_response
+        self.get_response = get_response
         djpj_setting = config or getattr(settings, 'DJPJ_PJAX_URLS', [])
         self.decorated_urls = self.parse_configuration(djpj_setting)
+        self.dispatcher = URLDispatcher(url_regex for url_regex, _
+                                        in self.decorated_urls)
+        if iscoroutinefunction(get_response):
+            from djpj import aio
+            # Django awaits this instance's __call__, which returns the
+            # coroutine from get_response.
+            aio.mark_coroutine_function(self)
+            self.process_template_response = types.MethodType(
+                aio.process_template_response, self)
+
+    def __call__(self, request):
+        self.process_request(request)
+        return self.get_response(request)
 
     @staticmethod
     def parse_decorator(decorator_string):
@@ -27,7 +126,8 @@ class DjangoPJAXMiddleware(object):
         Take a string containing Python code declaring a DjPj decorator, and
         return a corresponding decorator function. Syntax is limited to a
         single call to one of DjPj's decorators, without the use of *args or
-        **kwargs, and with string arguments only.
+        **kwargs, and with arguments that are strings, lists or tuples of
+        strings, True, False or None only.
 
         For example:
             "@pjax_block(block='content', title_variable='page_title')"
@@ -67,9 +167,10 @@ class DjangoPJAXMiddleware(object):
         if starargs:
             raise error("unpacking * and ** arguments is not supported")
 
-        if not all(isinstance(arg, ast.Str) for arg
+        if not all(_is_simple_literal(arg) for arg
                    in call.args + [kw.value for kw in call.keywords]):
-            raise error("only string arguments are allowed")
+            raise error("only string, list or tuple of string, True, False "
+                        "and None arguments are allowed")
 
         # If the syntax checks out, return the evaluated code.
         return eval(compile(expr, '<string>', mode='eval'))
@@ -85,7 +186,16 @@ class DjangoPJAXMiddleware(object):
         # For convenience, allow either a sequence of decorators or a single
         listify = lambda d: d if isinstance(d, (list, tuple)) else [d]
 
-        parse_fn = DjangoPJAXMiddleware.parse_decorator
+        # Each decorator string is only parsed once per process, however many
+        # times the configuration is, by middleware instances or warm_up().
+        def parse_fn(decorator_string):
+            decorator = _parsed_decorators.get(decorator_string)
+            if decorator is None:
+                decorator = DjangoPJAXMiddleware.parse_decorator(
+                    decorator_string)
+                _parsed_decorators[decorator_string] = decorator
+            return decorator
+
         return [(re.compile(url_regex),
                  [parse_fn(d) for d in reversed(listify(decorators))])
                 for url_regex, decorators in reversed(config_seq)]
@@ -98,9 +208,44 @@ class DjangoPJAXMiddleware(object):
         If the request URL matches a decorated URL, run the response through
         the corresponding decorators before returning it.
         """
-        for url_regex, decorators in self.decorated_urls:
-            if url_regex.match(request.path):
-                fake_view = lambda _: response
-                for decorator in decorators:
-                    response = decorator(fake_view)(request)
+        start = clock()
+        skips = self.skips(request, response)
+        for endpoint, decorator in self.matching_decorators(request):
+            if not (skips and decorator.only_varies(request)):
+                response = decorator.process_response(request, response,
+                                                      endpoint)
+        self.record_dispatch(response, start)
         return response
+
+    def skips(self, request, response):
+        # For anything but a PJAX request, most decorators only add a Vary
+        # header, so there's no need to call those if it's already set.
+        return not is_pjax(request) and _varies_on_containers(response)
+
+    def matching_decorators(self, request):
+        """
+        Generate (endpoint, decorator) pairs for each decorator configured for
+        the request's URL, in the order they should process its response.
+        """
+        record_metrics = metrics_enabled()
+        for i in self.dispatcher.match(request.path):
+            url_regex, decorators = self.decorated_urls[i]
+            if record_metrics:
+                count_request(url_regex.pattern, is_pjax(request))
+            for decorator in decorators:
+                yield url_regex.pattern, decorator
+
+    @staticmethod
+    def record_dispatch(response, start):
+        stats = getattr(response, 'djpj_stats', None)
+        if stats is not None:
+            stats.timings['dispatch'] = clock() - start
+
+
+# Decorators parsed by DjangoPJAXMiddleware.parse_configuration, by source.
+_parsed_decorators = dict()
+
+
+def _varies_on_containers(response):
+    vary = [h.strip().lower() for h in response.get('Vary', '').split(',')]
+    return all(h.lower() in vary for h in _vary_headers)
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent when a response processed by DjPj has been rendered, with the response
+# and a djpj.instrumentation.RenderStats as the "response" and "stats"
+# arguments. Responses are only measured while a receiver is connected, or
+# while the DJPJ_SERVER_TIMING setting is True.
+response_rendered = Signal()
@@ -0,0 +1,144 @@
+/*
+ * DjPj client helpers. Requires jQuery, which jquery-pjax depends on anyway.
+ *
+ * djpj.loadContainers(url, ['main', 'breadcrumb']) fetches several containers
+ * with a single request, and replaces the contents of each container (and the
+ * page title, if one is sent) with the result.
+ *
+ * djpj.loadLazyBlocks(element) fills in the placeholders of {% pjax_lazy %}
+ * blocks within element, fetching each block with a request of its own. It's
+ * called for the whole page once it's loaded, and for each container updated
+ * by jquery-pjax.
+ *
+ * djpj.loadBatch(batchUrl, [['/products/hat/', 'main'], ...]) fetches the
+ * given containers of several pages from DjPj's batch view with a single
+ * request, resolving to a list of {status, url, html} objects in order.
+ *
+ * jquery-pjax's requests are sent with an X-PJAX-Version header giving the
+ * page's layout version, from the tag rendered by {% pjax_version %}, so that
+ * DjPj can tell when the layout has changed without rendering anything.
+ */
+(function ($) {
+    'use strict';
+
+    // Each fragment is preceded by a comment holding its name and its length.
+    var frameRe = /<!--djpj-fragment (\S+) (\d+)-->/g;
+
+    function splitFragments(body) {
+        var fragments = {}, prefix = body, match, end;
+        frameRe.lastIndex = 0;
+        match = frameRe.exec(body);
+        if (match) {
+            prefix = body.slice(0, match.index);
+        }
+        while (match) {
+            end = frameRe.lastIndex + parseInt(match[2], 10);
+            fragments[match[1]] = body.slice(frameRe.lastIndex, end);
+            frameRe.lastIndex = end;
+            match = frameRe.exec(body);
+            if (match && match.index !== end) {
+                break;
+            }
+        }
+        return {prefix: prefix, fragments: fragments};
+    }
+
+    // Each item of a batch is preceded by its status, URL and length.
+    var itemRe = /<!--djpj-item (\d{3}) (\S+) (\d+)-->/g;
+
+    function splitItems(body) {
+        var items = [], match, end;
+        itemRe.lastIndex = 0;
+        match = itemRe.exec(body);
+        while (match && match.index === (end || 0)) {
+            end = itemRe.lastIndex + parseInt(match[3], 10);
+            items.push({
+                status: parseInt(match[1], 10),
+                url: match[2],
+                html: body.slice(itemRe.lastIndex, end)
+            });
+            itemRe.lastIndex = end;
+            match = itemRe.exec(body);
+        }
+        return items;
+    }
+
+    function loadBatch(batchUrl, items, ajaxOptions) {
+        return $.ajax($.extend({
+            url: batchUrl,
+            dataType: 'html',
+            traditional: true,
+            data: {
+                path: $.map(items, function (item) { return item[0]; }),
+                container: $.map(items, function (item) {
+                    return item[1].replace(/^#/, '');
+                })
+            }
+        }, ajaxOptions)).then(splitItems);
+    }
+
+    function loadContainers(url, containers, ajaxOptions) {
+        var selectors = $.map(containers, function (container) {
+            return '#' + container.replace(/^#/, '');
+        });
+        return $.ajax($.extend({
+            url: url,
+            dataType: 'html',
+            headers: {
+                'X-PJAX': 'true',
+                'X-PJAX-Container': selectors[0],
+                'X-DjPj-Containers': selectors.join(',')
+            }
+        }, ajaxOptions)).done(function (body) {
+            var result = splitFragments(body),
+                title = /<title>([\s\S]*?)<\/title>/.exec(result.prefix);
+            if (title) {
+                document.title = $('<textarea>').html(title[1]).text();
+            }
+            $.each(result.fragments, function (name, html) {
+                $('#' + name).html(html);
+            });
+        });
+    }
+
+    function loadLazyBlocks(element, ajaxOptions) {
+        return $.when.apply($, $('[data-djpj-lazy]', element).map(function () {
+            var placeholder = $(this),
+                name = placeholder.attr('data-djpj-lazy');
+            placeholder.removeAttr('data-djpj-lazy');
+            return $.ajax($.extend({
+                url: placeholder.attr('data-djpj-url'),
+                dataType: 'html',
+                headers: {
+                    'X-PJAX': 'true',
+                    'X-PJAX-Container': '#' + name,
+                    'X-DjPj-Lazy': name
+                }
+            }, ajaxOptions)).done(function (body) {
+                placeholder.html(body);
+                loadLazyBlocks(placeholder, ajaxOptions);
+            });
+        }).get());
+    }
+
+    $(function () {
+        loadLazyBlocks(document);
+    });
+    $(document).on('pjax:beforeSend', function (event, xhr) {
+        var version = $('meta[http-equiv="x-pjax-version"]').attr('content');
+        if (version) {
+            xhr.setRequestHeader('X-PJAX-Version', version);
+        }
+    });
+    $(document).on('pjax:end', function (event) {
+        loadLazyBlocks(event.target);
+    });
+
+    window.djpj = $.extend(window.djpj || {}, {
+        splitFragments: splitFragments,
+        loadContainers: loadContainers,
+        loadLazyBlocks: loadLazyBlocks,
+        splitItems: splitItems,
+        loadBatch: loadBatch
+    });
+}(jQuery));
@@ -1,19 +1,128 @@
+import functools
+import hashlib
+import logging
+import sys
+import weakref
+from contextlib import contextmanager
+
 from django import VERSION as DJANGO_VERSION
 
-from django.template import TemplateSyntaxError, NodeList, Template
+from django.conf import settings
+from django.template import (Context, NodeList, RequestContext, Template,
+                             TemplateDoesNotExist, TemplateSyntaxError)
+from django.template import context as context_module
+from django.db.models.query import QuerySet
+from django.template import defaulttags
+from django.template.base import (FilterExpression, Node, TextNode, Variable,
+                                  VariableNode)
+from django.template.context import RenderContext
+from django.template.defaulttags import (AutoEscapeControlNode, FilterNode,
+                                         ForNode, SpacelessNode, WithNode)
+from django.template.smartif import TokenBase
 if DJANGO_VERSION >= (1, 8):
     from django.template.context import make_context
 
 # TODO: Find out why Django raises InvalidTemplateLibrary without this import.
 from django.template.loader import get_template
 
-from django.template.loader_tags import BlockNode, ExtendsNode
+from django.template.loader_tags import (BLOCK_CONTEXT_KEY, BlockContext,
+                                        BlockNode, ExtendsNode, IncludeNode)
 from django.template.response import SimpleTemplateResponse
+from django.utils.functional import LazyObject, Promise
+
+from djpj.cache import cached_page, fragment_cache_key, page_cache_key
+from djpj.coalesce import in_flight
+from djpj.compat import (StreamingHttpResponse, force_bytes, force_text,
+                         string_types)
+from djpj.instrumentation import RenderStats, instrumentation_enabled, timer
+from djpj.utils import (frame_fragments, is_pjax, remembering_templates,
+                        select_existing_template, template_caches)
+
+logger = logging.getLogger('djpj')
 
-from djpj.compat import queue
+# Marks an attribute whose value hasn't been computed yet.
+_unknown = object()
 
 _wrapped_class_registry = {}
 
+# BlockIndex instances, keyed on the indexed template's origin and loader.
+_block_index_registry = {}
+
+# The parent templates of ExtendsNodes naming their parent with a constant.
+_parent_templates = weakref.WeakKeyDictionary()
+template_caches.append(_parent_templates)
+
+# Digests of the source of templates, for layout_version().
+_source_digests = weakref.WeakKeyDictionary()
+
+# Attributes used by Django's built-in tags, and by assignment tags, to hold
+# the name of the context variable they assign (as in "{% url ... as name %}").
+_assignment_attributes = ('asvar', 'target_var', 'var_name', 'variable_name',
+                          'variable', 'varname')
+
+
+# Nodes which may enclose a block that's rendered directly. Other than these,
+# only {% with %} and {% autoescape %} affect the context their contents see.
+_replayable_node_types = (BlockNode, WithNode, AutoEscapeControlNode,
+                          SpacelessNode, FilterNode)
+
+
+# Nodes which only read the context through the FilterExpressions and Variables
+# held in their attributes, and which render only the nodes they hold. Only
+# these exact types are trusted, since subclasses may override render().
+_analysable_node_types = frozenset(
+    [BlockNode, TextNode, VariableNode] +
+    [getattr(defaulttags, name) for name in (
+        'AutoEscapeControlNode', 'CommentNode', 'CsrfTokenNode', 'CycleNode',
+        'FilterNode', 'FirstOfNode', 'ForNode', 'IfChangedNode', 'IfEqualNode',
+        'IfNode', 'LoadNode', 'LoremNode', 'NowNode', 'RegroupNode',
+        'ResetCycleNode', 'SpacelessNode', 'TemplateTagNode', 'URLNode',
+        'VerbatimNode', 'WidthRatioNode', 'WithNode')
+     if hasattr(defaulttags, name)])
+
+# Names read from the context by nodes, other than through their arguments.
+_implicit_context_names = ('csrf_token',)
+
+# The child nodelists that nodes which push the context render without doing
+# so. Other nodes render their child nodelists in the context they're given.
+_unscoped_nodelists = {WithNode: (), ForNode: ('nodelist_empty',)}
+
+
+def _assigns_context_variable(node):
+    """
+    Return whether rendering a node may assign a context variable that the
+    nodes after it could read, either itself or through a node within it,
+    such as an assignment inside an {% if %} tag. Nodes other than Django's
+    built-in tags and simple and inclusion tags are assumed to.
+    """
+    node_stack = [node]
+    while node_stack:
+        node = node_stack.pop()
+        if any(getattr(node, attr, None) for attr in _assignment_attributes):
+            return True
+        # Blocks and included templates are rendered in a context of their
+        # own, and nodes like {% pjax_skip %} aren't rendered with blocks.
+        if (isinstance(node, (BlockNode, IncludeNode)) or
+                getattr(node, 'djpj_skipped', False)):
+            continue
+        if not (type(node) in _analysable_node_types or
+                hasattr(node, 'get_resolved_arguments')):
+            return True
+        for attr in _unscoped_nodelists.get(type(node), node.child_nodelists):
+            node_stack.extend(getattr(node, attr, None) or ())
+    return False
+
+
+def _node_weight(node):
+    # A node counts for itself and the nodes in any child nodelists that
+    # BlockIndex doesn't walk, such as the body of a {% for %} loop.
+    weight = 1
+    for attr in getattr(node, 'child_nodelists', ()):
+        child_nodes = getattr(node, attr, None)
+        if attr != 'nodelist' and child_nodes:
+            weight += len(child_nodes.get_nodes_by_type(Node))
+    return weight
+
 
 class StopRendering(Exception):
     """
@@ -24,6 +133,148 @@ class StopRendering(Exception):
     pass
 
 
+class DirectRenderingUnsupported(Exception):
+    """
+    Thrown by render_blocks_directly() when the structure of a template means
+    its blocks can't safely be rendered without rendering the whole template.
+    """
+    pass
+
+
+class BlockIndex(object):
+    """
+    A read-only summary of a compiled template's node tree: a map of block
+    names to BlockNodes, the template's ExtendsNodes, and for each block the
+    path of nodes leading to it from the root of the template.
+
+    Building one requires a walk of the entire tree, so use for_template()
+    to fetch a shared index rather than instantiating this class directly.
+    Indexes never modify the template they describe, so they can be shared
+    freely between requests and threads.
+    """
+
+    def __init__(self, template):
+        self.blocks = dict()
+        self.paths = dict()
+        self.extends_nodes = []
+
+        # The names of blocks preceded, within their enclosing block, by a
+        # node which may assign a context variable that the block could read.
+        self.assigned_before = set()
+
+        # The content of the template and of each block, in document order, as
+        # lists of node counts and the names of nested blocks. The template's
+        # own content is listed under None.
+        self.layout = dict()
+
+        # Results of _used_context_names() for this template's blocks.
+        self.used_context_names = dict()
+
+        # Django only honours an {% extends %} tag at the start of a template.
+        self.extends_node = None
+        for node in template.nodelist:
+            if not isinstance(node, TextNode):
+                if isinstance(node, ExtendsNode):
+                    self.extends_node = node
+                break
+
+        # Walk the tree depth-first, in document order, keeping track of each
+        # node's ancestors. Like Django's own BlockNode and ExtendsNode, only
+        # descend into child nodes found at the "nodelist" attribute.
+        node_stack = self._child_entries(template.nodelist, (), False)
+        while node_stack:
+            node, path, assigned = node_stack.pop()
+            scope = next((n.name for n in reversed(path)
+                          if isinstance(n, BlockNode)), None)
+            content = self.layout.setdefault(scope, [])
+            if isinstance(node, BlockNode):
+                self.blocks[node.name] = node
+                self.paths[node.name] = path
+                if assigned:
+                    self.assigned_before.add(node.name)
+                content.append(node.name)
+            else:
+                if isinstance(node, ExtendsNode):
+                    self.extends_nodes.append(node)
+                if content and isinstance(content[-1], int):
+                    content[-1] += _node_weight(node)
+                else:
+                    content.append(_node_weight(node))
+            child_nodes = getattr(node, 'nodelist', None)
+            if child_nodes:
+                # Blocks get a fresh context, and so do extending templates,
+                # since Django ignores any content outside their blocks.
+                if isinstance(node, (BlockNode, ExtendsNode)):
+                    assigned = False
+                node_stack.extend(self._child_entries(
+                    child_nodes, path + (node,), assigned))
+
+    @staticmethod
+    def _child_entries(nodes, path, assigned):
+        # Return stack entries for nodes in reverse order, so that they are
+        # popped in document order, each noting whether an earlier sibling
+        # may have assigned a context variable.
+        entries = []
+        for node in nodes:
+            entries.append((node, path, assigned))
+            assigned = assigned or _assigns_context_variable(node)
+        entries.reverse()
+        return entries
+
+    @property
+    def all_blocks(self):
+        """
+        Every BlockNode in the template, found the same way ExtendsNode finds
+        the blocks of a root template, which may include blocks not reached
+        through "nodelist" attributes (inside {% for %} tags, for example).
+        """
+        try:
+            return self._all_blocks
+        except AttributeError:
+            template = self.template
+            self._all_blocks = dict(
+                (n.name, n) for n in
+                template.nodelist.get_nodes_by_type(BlockNode))
+            return self._all_blocks
+
+    @staticmethod
+    def _registry_key(template):
+        # Django >= 1.9 records the loader that produced each template, and the
+        # cached loader produces a new Template whenever it's reset, so the
+        # origin is a stable key. Fall back to the object's identity otherwise.
+        origin = getattr(template, 'origin', None)
+        loader = getattr(origin, 'loader', None)
+        if loader is None:
+            return id(template)
+        return getattr(origin, 'name', None), loader
+
+    @classmethod
+    def for_template(cls, template):
+        """
+        Return the BlockIndex for the given template, building it if this is
+        the first time the template has been seen. An index is discarded when
+        its template is garbage collected, or replaced by a reloaded template
+        from the same origin.
+        """
+        key = cls._registry_key(template)
+        index = _block_index_registry.get(key)
+        if index is None or index.template is not template:
+            index = cls(template)
+
+            def discard(_):
+                if _block_index_registry.get(key) is index:
+                    _block_index_registry.pop(key, None)
+
+            index._template_ref = weakref.ref(template, discard)
+            _block_index_registry[key] = index
+        return index
+
+    @property
+    def template(self):
+        template_ref = getattr(self, '_template_ref', None)
+        return template_ref() if template_ref else None
+
+
 class DjPjObject(object):
     """
     This is a base class used for wrapping various Django template structures.
@@ -94,6 +345,10 @@ class DjPjNodeList(DjPjObject, NodeList):
         self._djpj_block_name = block_name
 
     def render(self, context):
+        page_blocks = getattr(context, 'djpj_page_blocks', None)
+        if page_blocks is not None:
+            return page_blocks.capture(self._djpj_block_name, functools.partial(
+                super(DjPjNodeList, self).render, context))
         result = super(DjPjNodeList, self).render(context)
         try:
             if self._djpj_block_name in context.djpj_blocks:
@@ -105,10 +360,55 @@ class DjPjNodeList(DjPjObject, NodeList):
         return result
 
 
+class PageBlocks(object):
+    """
+    Records the output of each block rendered into a whole page, so that
+    where each block's output is in the page can be found once it's rendered.
+    Set an instance as the djpj_page_blocks attribute of the context used to
+    render a patched template, then pass the output to offsets(). The output
+    itself is left as it is, since the tags around a block may measure it.
+    """
+
+    def __init__(self):
+        self.outputs = dict()
+        self._rendering = []
+
+    def capture(self, name, render):
+        """Return the output of render(), which renders the named block."""
+        # A block rendered within itself is its parent's version, rendered
+        # for {{ block.super }}, which is part of the block's own output.
+        nested = name in self._rendering
+        self._rendering.append(name)
+        try:
+            output = render()
+        finally:
+            self._rendering.pop()
+        if not nested:
+            self.outputs.setdefault(name, []).append(output)
+        return output
+
+    def offsets(self, content):
+        """
+        Return a dict mapping block names to the (start, end) offsets of their
+        output in the rendered page. Blocks rendered more than once, or whose
+        output was altered by the tags around them, are left out.
+        """
+        offsets = dict()
+        for name, outputs in self.outputs.items():
+            start = content.find(outputs[0]) if len(outputs) == 1 else -1
+            if start != -1:
+                offsets[name] = start, start + len(outputs[0])
+        return offsets
+
+
 class DjPjExtendsNode(DjPjObject, ExtendsNode):
-    def get_parent(self, *args, **kwargs):
-        parent = super(DjPjExtendsNode, self).get_parent(*args, **kwargs)
+    def get_parent(self, context):
+        parent = parent_template(self, context)
         DjPjTemplate.patch(parent, exclude_blocks=self.blocks)
+        # Extend the inheritance chain recorded by render_blocks().
+        chain = getattr(context, 'djpj_chain', None)
+        if chain and BlockIndex.for_template(chain[-1]).extends_node is self:
+            chain.append(parent)
         return parent
 
 
@@ -125,42 +425,620 @@ class DjPjTemplate(DjPjObject, Template):
 
     def _initialise_blocks(self, excluded):
         """
-        Walk the template tree and convert all necessary objects into their
-        DjPj equivalents. This includes ExtendsNodes and BlockNodes' NodeLists
+        Convert all necessary objects in the template tree into their DjPj
+        equivalents. This includes ExtendsNodes and BlockNodes' NodeLists
         (but not BlockNodes themselves as they're not actually rendered from
         the template tree - see the source for BlockNode.render().
         """
+        index = BlockIndex.for_template(self)
         blocks = dict()
-        node_queue = queue.Queue()
-        node_queue.put(self)
-        while True:
-            try:
-                node = node_queue.get(False)
-            except queue.Empty:
-                break
-            if hasattr(node, 'nodelist'):
-                if isinstance(node, BlockNode) and node.name not in excluded:
-                    DjPjNodeList.patch(node.nodelist, node.name)
-                    blocks[node.name] = node
-                for child_node in node.nodelist:
-                    node_queue.put(child_node)
-            if isinstance(node, ExtendsNode):
-                DjPjExtendsNode.patch(node)
-        del node_queue
+        for name, node in index.blocks.items():
+            if name not in excluded:
+                DjPjNodeList.patch(node.nodelist, name)
+                blocks[name] = node
+        for node in index.extends_nodes:
+            DjPjExtendsNode.patch(node)
 
         return blocks
 
-    def render_blocks(self, context, blocks):
+    def render_blocks(self, context, blocks, stats=None):
         """
         Return a dict mapping block names to their rendered contents. If a
         block is not rendered, its name will map to None.
+
+        If a djpj.instrumentation.RenderStats is passed, the rendering is
+        recorded in it.
         """
         context.djpj_blocks = dict((b, None) for b in blocks if b)
+        context.djpj_rendering_blocks = list(context.djpj_blocks)
+        context.djpj_chain = [self]
+        with timer(stats, 'render'):
+            try:
+                self.render(context)
+            except StopRendering:
+                if stats is not None:
+                    stats.stopped_early = True
+        return context.djpj_blocks
+
+
+def rendering_blocks(context):
+    """
+    Return the names of the blocks the context is being used to render for a
+    PJAX response, by render_blocks() or one of its alternatives, or an empty
+    list if it's being used to render a whole page.
+    """
+    return getattr(context, 'djpj_rendering_blocks', [])
+
+
+def constant_parent_name(extends_node):
+    """
+    Return the template name given to an {% extends %} tag as a string
+    literal, or None if its parent is given by a variable.
+    """
+    parent_name = extends_node.parent_name
+    if parent_name.filters or isinstance(parent_name.var, Variable):
+        return None
+    return parent_name.var
+
+
+def parent_template(extends_node, context):
+    """
+    Return the template extended by extends_node, as ExtendsNode.get_parent()
+    does. A parent named by a constant is remembered, so that it's only looked
+    up once, until the template settings change or the autoreloader sees a
+    file change.
+    """
+    # Call ExtendsNode's own method, so that the lookup isn't repeated by a
+    # patched node.
+    name = constant_parent_name(extends_node)
+    if name is None or not remembering_templates():
+        return ExtendsNode.get_parent(extends_node, context)
+
+    # Django skips templates already in the inheritance chain, so that a
+    # template can extend another with the same name. That makes the parent
+    # depend on the chain, so take the slow path if it includes the name.
+    context_key = getattr(extends_node, 'context_key', None)
+    history = (context.render_context.setdefault(
+        context_key, [extends_node.origin]) if context_key else ())
+    if any(getattr(origin, 'template_name', None) == name
+           for origin in history):
+        return ExtendsNode.get_parent(extends_node, context)
+
+    parent = _parent_templates.get(extends_node)
+    if parent is None:
+        parent = ExtendsNode.get_parent(extends_node, context)
+        _parent_templates[extends_node] = parent
+    elif context_key:
+        history.append(parent.origin)
+    return parent
+
+
+def _resolve_inheritance_chain(template, context):
+    """
+    Return a list of templates starting with the given template, followed by
+    its parent, its parent's parent and so on until the root template.
+    """
+    chain = [template]
+    extends_node = BlockIndex.for_template(template).extends_node
+    while extends_node is not None:
+        # Fetch the parent without patching it.
+        parent = parent_template(extends_node, context)
+        chain.append(parent)
+        extends_node = BlockIndex.for_template(parent).extends_node
+    return chain
+
+
+def layout_version(template, context_data=None):
+    """
+    Return a fingerprint of the layout a template is rendered in, to send to
+    jquery-pjax as the X-PJAX-Version header. It's a digest of the source of
+    the templates it extends, or if it extends none, of its own source, and
+    None if its parents can't be found.
+    """
+    # As in _block_context_names(), a plain context will do, as it's only
+    # needed for any {% extends %} tags naming their parent with a variable.
+    context = Context(context_data)
+    try:
+        with _template_render_state(template, context):
+            chain = _resolve_inheritance_chain(template, context)
+    except (TemplateSyntaxError, TemplateDoesNotExist):
+        return None
+    digests = ''.join(_source_digest(t) for t in chain[1:] or chain)
+    return hashlib.md5(digests.encode('utf-8')).hexdigest()[:16]
+
+
+def _source_digest(template):
+    # A compiled template's source never changes, so its digest can be kept
+    # for as long as the template is.
+    digest = _source_digests.get(template)
+    if digest is None:
+        # Before Django 1.9, templates don't keep their source.
+        source = getattr(template, 'source', None)
+        if source is None:
+            origin = getattr(template, 'origin', None)
+            source = getattr(origin, 'name', None) or template.name or ''
+        digest = hashlib.md5(force_bytes(source)).hexdigest()
+        _source_digests[template] = digest
+    return digest
+
+
+def _document_spans(indexes):
+    """
+    Given the BlockIndexes of an inheritance chain, most derived first, return
+    the number of nodes in the page they render, and a dict mapping each block
+    name to the positions, counting nodes in document order, of its BlockNode
+    and of its last node.
+    """
+    owners = dict()
+    for index in reversed(indexes):
+        owners.update(dict.fromkeys(index.blocks, index))
+    spans = dict()
+
+    def walk(scope, index, position):
+        for item in index.layout.get(scope, ()):
+            if isinstance(item, int):
+                position += item
+            else:
+                start = position + 1
+                position = walk(item, owners[item], start)
+                spans.setdefault(item, (start, position))
+        return position
+
+    return walk(None, indexes[-1], 0), spans
+
+
+def _count_nodes(template, context, blocks, stats):
+    """
+    Record in stats how many nodes the template's page has, and how many were
+    rendered, according to whether its blocks were rendered directly or by
+    walking the page until stats.stopped_early.
+    """
+    # Use the inheritance chain found while rendering, where it was recorded.
+    chain = getattr(context, 'djpj_chain', None)
+    if (not chain or chain[0] is not template or
+            BlockIndex.for_template(chain[-1]).extends_node is not None):
+        with _template_render_state(template, context):
+            chain = _resolve_inheritance_chain(template, context)
+    total, spans = _document_spans([BlockIndex.for_template(t) for t in chain])
+    block_spans = [spans[b] for b in blocks if b in spans]
+    if stats.mode == 'direct':
+        rendered = sum(end - start + 1 for start, end in block_spans)
+    elif stats.stopped_early and block_spans:
+        rendered = max(end for _, end in block_spans)
+    else:
+        rendered = total
+    stats.nodes_total, stats.nodes_rendered = total, rendered
+
+
+def _is_analysable(node):
+    if type(node) in _analysable_node_types:
+        return True
+    # Simple and inclusion tags are safe unless they're passed the context.
+    return (hasattr(node, 'get_resolved_arguments') and
+            getattr(node, 'takes_context', True) is False)
+
+
+def _referenced_names(nodes, descend=True):
+    """
+    Return a set of the names of the context variables read by the given nodes
+    and, if descend is True, their child nodes, along with a set of the names
+    of any blocks found among them. Return None if any of the nodes might read
+    the context in a way that can't be determined.
+    """
+    names = set(_implicit_context_names)
+    block_names = set()
+    node_stack = list(nodes)
+    while node_stack:
+        node = node_stack.pop()
+        if getattr(node, 'djpj_skipped', False):
+            # Nodes like {% pjax_skip %} render nothing while blocks are.
+            continue
+        if isinstance(node, ExtendsNode) and not descend:
+            pass
+        elif not _is_analysable(node):
+            return None
+        if isinstance(node, BlockNode):
+            block_names.add(node.name)
+        values = list(vars(node).values())
+        while values:
+            value = values.pop()
+            if isinstance(value, (Node, NodeList)):
+                if descend:
+                    node_stack.extend([value] if isinstance(value, Node)
+                                      else value)
+            elif isinstance(value, FilterExpression):
+                values.append(value.var)
+                for _, args in value.filters:
+                    values.extend(arg for _, arg in args)
+            elif isinstance(value, Variable):
+                if value.lookups:
+                    names.add(value.lookups[0])
+            elif isinstance(value, TokenBase):
+                values.extend(vars(value).values())
+            elif isinstance(value, (list, tuple)):
+                values.extend(value)
+            elif isinstance(value, dict):
+                values.extend(value.values())
+    return names, block_names
+
+
+def _used_context_names(indexes, blocks):
+    """
+    Return the set of context variable names that rendering the given blocks
+    of an inheritance chain of BlockIndexes might read, or None if that can't
+    be determined. That's every name used by any version of each block or the
+    blocks within it, by the tags enclosing them, and by {% extends %} tags.
+    Results are remembered by the index of the most derived template.
+    """
+    key = (tuple(indexes[1:]), tuple(blocks))
+    memo = indexes[0].used_context_names
+    try:
+        return memo[key]
+    except KeyError:
+        pass
+
+    names = set()
+    for index in indexes:
+        if index.extends_node is not None:
+            names.update(_referenced_names([index.extends_node], False)[0])
+
+    pending, seen = list(blocks), set()
+    while pending and names is not None:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for index in indexes:
+            node = index.blocks.get(name)
+            if node is None:
+                continue
+            # A variable assigned before the block might be derived from
+            # anything in the context.
+            referenced = (None if name in index.assigned_before else
+                          _referenced_names(node.nodelist))
+            enclosing = _referenced_names(index.paths[name], False)
+            if referenced is None or enclosing is None:
+                names = None
+                break
+            names.update(referenced[0], enclosing[0])
+            pending.extend(referenced[1])
+
+    memo[key] = names
+    return names
+
+
+def _is_lazy(value):
+    return (callable(value) or
+            isinstance(value, (Promise, LazyObject, QuerySet)))
+
+
+def _block_context_names(template, context_data, blocks):
+    """
+    Return the set of context variable names that rendering the given blocks
+    of a template might read, or None if that can't be determined.
+    """
+    # Resolve the inheritance chain with a plain context, as it's only needed
+    # for any {% extends %} tags naming their parent with a variable.
+    context = Context(context_data)
+    try:
+        with _template_render_state(template, context):
+            chain = _resolve_inheritance_chain(template, context)
+    except (TemplateSyntaxError, TemplateDoesNotExist):
+        return None
+    return _used_context_names([BlockIndex.for_template(t) for t in chain],
+                               [b for b in blocks if b])
+
+
+# The keys seen in the output of each context processor run by a
+# ProcessorSelectingRequestContext.
+_context_processor_keys = dict()
+
+
+def _import_string(path):
+    from django.utils.module_loading import import_string
+    return import_string(path)
+
+
+def _builtin_context_processors():
+    # Django 1.8+ always runs these, whatever the engine is configured with.
+    return tuple(_import_string(p) for p in
+                 getattr(context_module, '_builtin_context_processors', ()))
+
+
+class ProcessorSelectingRequestContext(RequestContext):
+    """
+    A RequestContext that runs only the context processors it's given, and
+    not the template engine's, when it's bound to a template. The keys each
+    processor provides are recorded, for pjax_block's "auto" selection.
+    """
+
+    @contextmanager
+    def bind_template(self, template):
+        if self.template is not None:
+            raise RuntimeError("Context is already bound to a template")
+
+        self.template = template
+        updates = {}
+        for processor in self._processors:
+            processed = processor(self.request)
+            # A processor may provide nothing for some requests, like a
+            # cart's for anonymous users, so that tells nothing of its keys.
+            if processed:
+                _context_processor_keys[processor] = (
+                    _context_processor_keys.get(processor, frozenset()) |
+                    frozenset(processed))
+            updates.update(processed)
+        self.dicts[self._processors_index] = updates
+
+        try:
+            yield
+        finally:
+            self.template = None
+            self.dicts[self._processors_index] = {}
+
+
+def _locate_block(name, indexes, block_context, seen=()):
+    """
+    Find where the named block is rendered in a chain of BlockIndexes, most
+    derived first. Return the effective ancestors of the block, outermost
+    first, and a BlockNode with the given name at that location.
+    """
+    if name in seen:
+        raise DirectRenderingUnsupported("Blocks nest recursively")
+    root_index = indexes[-1]
+    for index in indexes:
+        node = index.blocks.get(name)
+        if node is None:
+            continue
+        if name in index.assigned_before:
+            raise DirectRenderingUnsupported(
+                "Block '%s' may depend on a preceding assignment" % name)
+        path = list(index.paths[name])
+        enclosing = [i for i, n in enumerate(path) if isinstance(n, BlockNode)]
+        if index is not root_index:
+            # Outside of their blocks, extending templates aren't rendered, so
+            # a top-level block is placed wherever its parent places it.
+            if not enclosing:
+                continue
+            path = path[enclosing[0]:]
+            enclosing = [i - enclosing[0] for i in enclosing]
+        if not enclosing:
+            return path, node
+        # If our block's nearest enclosing block is overridden elsewhere in
+        # the chain, it's only rendered via {{ block.super }}, if at all.
+        inner = path[enclosing[-1]]
+        if block_context and block_context.get_block(inner.name) is not inner:
+            continue
+        outer_path, _ = _locate_block(inner.name, indexes, block_context,
+                                      seen + (name,))
+        return outer_path + path[enclosing[-1]:], node
+    raise DirectRenderingUnsupported("Block '%s' could not be found" % name)
+
+
+def _check_replayable(ancestors):
+    for ancestor in ancestors:
+        if not isinstance(ancestor, _replayable_node_types):
+            raise DirectRenderingUnsupported(
+                "Can't replay the effects of %s" % type(ancestor).__name__)
+
+
+@contextmanager
+def _replayed_ancestors(ancestors, context):
+    """
+    Replay the effects that a block's ancestors would have on the context,
+    had the whole template been rendered.
+    """
+    pushed = 0
+    autoescape = context.autoescape
+    try:
+        for ancestor in ancestors:
+            if isinstance(ancestor, WithNode):
+                context.update(dict((key, value.resolve(context)) for key, value
+                                    in ancestor.extra_context.items()))
+                pushed += 1
+            elif isinstance(ancestor, AutoEscapeControlNode):
+                context.autoescape = ancestor.setting
+        yield
+    finally:
+        context.autoescape = autoescape
+        for _ in range(pushed):
+            context.pop()
+
+
+def _render_block_in_place(node, ancestors, context):
+    with _replayed_ancestors(ancestors, context):
+        return node.render(context)
+
+
+def _iter_block_in_place(node, ancestors, context):
+    """
+    Like _render_block_in_place(), but generate the output of each of the
+    block's top-level nodes in turn. This follows BlockNode.render().
+    """
+    with _replayed_ancestors(ancestors, context):
+        block_context = context.render_context.get(BLOCK_CONTEXT_KEY)
+        push = None
+        with context.push():
+            if block_context is None:
+                block = node
+            else:
+                push = block = block_context.pop(node.name)
+                if block is None:
+                    block = node
+                block = type(node)(block.name, block.nodelist)
+                block.context = context
+            context['block'] = block
+            try:
+                for child in block.nodelist:
+                    if isinstance(child, Node):
+                        yield force_text(child.render_annotated(context))
+                    else:
+                        yield force_text(child)
+            finally:
+                if push is not None:
+                    block_context.push(node.name, push)
+
+
+@contextmanager
+def _direct_render_state(template, context, blocks, stats=None):
+    """
+    Prepare to render the given blocks of a template directly. Yields a dict
+    mapping each block name to its ancestors and a BlockNode to render.
+    """
+    if not hasattr(RenderContext, 'push_state'):
+        raise DirectRenderingUnsupported("Requires Django 1.11 or later")
+
+    render_context = context.render_context
+    context.djpj_rendering_blocks = [b for b in blocks if b]
+    with _template_render_state(template, context):
+        with timer(stats, 'index'):
+            chain = _resolve_inheritance_chain(template, context)
+            context.djpj_chain = chain
+            indexes = [BlockIndex.for_template(t) for t in chain]
+            # As in ExtendsNode.render(), only extending templates get a block
+            # context, which is populated from each template in the chain.
+            block_context = None
+            if len(chain) > 1:
+                block_context = BlockContext()
+                for index in indexes[:-1]:
+                    block_context.add_blocks(index.extends_node.blocks)
+                block_context.add_blocks(indexes[-1].all_blocks)
+                render_context[BLOCK_CONTEXT_KEY] = block_context
+
+            located = dict((b, _locate_block(b, indexes, block_context))
+                           for b in blocks if b)
+            for ancestors, _ in located.values():
+                _check_replayable(ancestors)
+        with render_context.push_state(chain[-1], isolated_context=False):
+            yield located
+
+
+def render_blocks_directly(template, context, blocks, stats=None):
+    """
+    Return a dict mapping block names to their rendered contents, like
+    DjPjTemplate.render_blocks(), but without rendering anything outside the
+    blocks. Instead, the inheritance chain is resolved and the blocks are
+    rendered in isolation, replaying only the {% with %} and {% autoescape %}
+    tags that enclose them.
+
+    Raises DirectRenderingUnsupported when that can't be done safely, in which
+    case the caller should render the whole template instead.
+    """
+    with _direct_render_state(template, context, blocks, stats) as located:
+        with timer(stats, 'render'):
+            return dict((b, _render_block_in_place(node, ancestors, context))
+                        for b, (ancestors, node) in located.items())
+
+
+class CapturingBlockContext(BlockContext):
+    """
+    A BlockContext that captures the output of the named blocks during a
+    single render. This lets render_blocks_unpatched() capture blocks using
+    per-render objects, where DjPjTemplate patches the shared template tree.
+
+    The first time each target block is popped - which is where the most
+    derived version of the block is rendered - it is swapped for a copy whose
+    nodelist reports its output back here. Later pops, as in block.super, are
+    left alone.
+    """
+
+    def __init__(self, blocks):
+        super(CapturingBlockContext, self).__init__()
+        self.captured = dict((b, None) for b in blocks if b)
+        self._popped = set()
+
+    def pop(self, name):
+        block = super(CapturingBlockContext, self).pop(name)
+        if (block is not None and name in self.captured
+                and name not in self._popped):
+            self._popped.add(name)
+            nodelist = CapturingNodeList(block.nodelist)
+            nodelist.block_name, nodelist.block_context = name, self
+            block = type(block)(block.name, nodelist)
+        return block
+
+    def capture(self, name, result):
+        self.captured[name] = result
+        if None not in self.captured.values():
+            raise StopRendering
+
+
+class CapturingNodeList(NodeList):
+    """
+    A copy of a block's nodelist, made for a single render, that passes its
+    output to the CapturingBlockContext which created it.
+    """
+
+    def render(self, context):
+        result = super(CapturingNodeList, self).render(context)
+        self.block_context.capture(self.block_name, result)
+        return result
+
+
+@contextmanager
+def _template_render_state(template, context):
+    """
+    Prepare the context to render the given template, as Template.render()
+    does, for code that needs to call Template._render() itself.
+    """
+    render_context = context.render_context
+    if hasattr(render_context, 'push_state'):
+        state = render_context.push_state(template)
+    else:
+        state = _pushed(render_context)
+    with state:
+        # Django >= 1.8 binds the outermost template rendered to the context.
+        if getattr(context, 'template', False) is None:
+            with context.bind_template(template):
+                context.template_name = getattr(template, 'name', None)
+                yield
+        else:
+            yield
+
+
+@contextmanager
+def _pushed(render_context):
+    render_context.push()
+    try:
+        yield
+    finally:
+        render_context.pop()
+
+
+def render_blocks_unpatched(template, context, blocks, stats=None):
+    """
+    Return a dict mapping block names to their rendered contents, like
+    DjPjTemplate.render_blocks(), but without patching the template. Blocks are
+    captured by objects that belong to this render alone, so templates shared
+    between threads (as with Django's cached loader) are never modified.
+    """
+    block_context = CapturingBlockContext(blocks)
+    context.djpj_rendering_blocks = list(block_context.captured)
+
+    # Templates that extend another are given their blocks by their ExtendsNode
+    # while rendering; a root template's blocks have to be added here.
+    with timer(stats, 'index'):
+        index = BlockIndex.for_template(template)
+        if index.extends_node is None:
+            block_context.add_blocks(index.all_blocks)
+
+    with _template_render_state(template, context), timer(stats, 'render'):
+        context.render_context[BLOCK_CONTEXT_KEY] = block_context
         try:
-            self.render(context)
+            template._render(context)
         except StopRendering:
-            pass
-        return context.djpj_blocks
+            if stats is not None:
+                stats.stopped_early = True
+    return block_context.captured
+
+
+def _set_mode(stats, mode):
+    if stats is not None:
+        stats.mode = mode
+
+
+def _new_instance(cls):
+    return cls.__new__(cls)
 
 
 class PJAXTemplateResponse(DjPjObject, SimpleTemplateResponse):
@@ -172,30 +1050,49 @@ class PJAXTemplateResponse(DjPjObject, SimpleTemplateResponse):
     accessed, we
     """
 
-    def __patch__(self, block_name, title_block_name, title_variable):
+    def __patch__(self, block_name, title_block_name, title_variable,
+                  fragment_cache=None, fragment_cache_key=None,
+                  context_processors=None, coalesce=None, slice_pages=False):
         self._djpj_block_name = block_name
         self._djpj_title_block_name = title_block_name
         self._djpj_title_variable = title_variable
+        self._djpj_fragment_cache = fragment_cache
+        self._djpj_fragment_cache_key = fragment_cache_key
+        self._djpj_context_processors = context_processors
+        self._djpj_coalesce = coalesce
+        self._djpj_slice_pages = slice_pages
+        self._djpj_context_names = _unknown
+        self._djpj_cached_fragment = _unknown
+        self.djpj_stats = (RenderStats(self._target_blocks())
+                           if instrumentation_enabled() else None)
 
-    @property
-    def rendered_content(self):
-        """
-        Walk the template's node tree, casting our target blocks' nodelists to
-        PJAXBlockNodeList in order to store its output in the render context.
-        Then render the template as usual, but instead of returning the result,
-        return the captured output from our target block(s).
-        """
+    @classmethod
+    def patch(cls, obj, *args, **kwargs):
+        # DjPj's decorators patch responses without a block just to measure
+        # them. A later pjax_block decorator may still give them one.
+        if isinstance(obj, cls) and not obj._djpj_block_name:
+            obj.__patch__(*args, **kwargs)
+        return super(PJAXTemplateResponse, cls).patch(obj, *args, **kwargs)
 
-        # just for convenience
-        block = self._djpj_block_name
-        title_block = self._djpj_title_block_name
-        title_var = self._djpj_title_variable
+    def __getstate__(self):
+        # Caches such as Django's cache middleware's pickle rendered
+        # responses, which don't need DjPj's attributes.
+        state = super(PJAXTemplateResponse, self).__getstate__()
+        return dict((name, value) for name, value in state.items()
+                    if not name.startswith('_djpj_') and name != 'djpj_stats')
 
-        # If no block name is specified, assume we're rendering a PJAX-specific
-        # template and just return the rendered output.
-        if not block:
-            return super(PJAXTemplateResponse, self).rendered_content
+    def __reduce_ex__(self, protocol):
+        # Pickle the response as the class it was patched from, since the
+        # patched class can't be found by name.
+        return _new_instance, (type(self).__bases__[1],), self.__getstate__()
+
+    def resolve_template(self, template):
+        # Skip the candidate templates known not to exist.
+        if isinstance(template, (list, tuple)) and DJANGO_VERSION >= (1, 8):
+            return select_existing_template(template, using=self.using)
+        return super(PJAXTemplateResponse, self).resolve_template(template)
 
+    def _resolve_template_and_context(self):
         # Get a Template object
         template = self.resolve_template(self.template_name)
 
@@ -204,28 +1101,440 @@ class PJAXTemplateResponse(DjPjObject, SimpleTemplateResponse):
         # django.template.Template as its "template" attribute. Template template.
         # Also, resolve_context returns a backend-agnostic dict, not a Context.
         if DJANGO_VERSION >= (1, 8):
-            context = (make_context(self.context_data, self._request)
-                       if isinstance(self.context_data, dict) else self.context_data)
             template = template.template
+            context = (self._make_context(template, self.context_data)
+                       if isinstance(self.context_data, dict) else self.context_data)
         else:
             context = self.resolve_context(self.context_data)
+        return template, context
 
-        # Otherwise, proceed to capture the output from the pjax block and,
-        # if specified, the title block or variable.
-        DjPjTemplate.patch(template)
-        target_blocks = filter(None, (block, title_block))
-        rendered_blocks = template.render_blocks(context, target_blocks)
+    def _make_context(self, template, context_data):
+        # As make_context() does, but running only the selected processors.
+        request = self._request
+        if self._djpj_context_processors is None or request is None:
+            return make_context(context_data, request)
+        context = ProcessorSelectingRequestContext(
+            request, processors=self._selected_context_processors(template))
+        if context_data:
+            context.push(context_data)
+        return context
+
+    def _selected_context_processors(self, template):
+        """
+        Return the context processors to run for this response, according to
+        its context_processors argument: either a list of processors to run as
+        well as Django's built-in ones, or "auto" to run the engine's
+        processors except those known to provide no context variable that the
+        target blocks use.
+        """
+        processors = self._djpj_context_processors
+        if processors != 'auto':
+            return _builtin_context_processors() + tuple(
+                _import_string(p) if isinstance(p, string_types) else p
+                for p in processors)
+        engine_processors = template.engine.template_context_processors
+        names = self._context_names(template)
+        if names is None:
+            return engine_processors
+        return tuple(p for p in engine_processors
+                     if _context_processor_keys.get(p) is None or
+                     _context_processor_keys[p] & names)
+
+    def _context_names(self, template):
+        """
+        Return the set of context variable names that rendering the target
+        blocks and title might use, or None if that can't be determined.
+        """
+        if self._djpj_context_names is _unknown:
+            names = _block_context_names(template, self.context_data,
+                                         self._target_blocks())
+            if names is not None and self._djpj_title_variable:
+                names = names | set([self._djpj_title_variable])
+            self._djpj_context_names = names
+        return self._djpj_context_names
+
+    def _without_unused_context(self, template, context, stats=None):
+        """
+        With the DJPJ_LAZY_CONTEXT setting, return a context made without any
+        callables, lazy objects or querysets in context_data which the target
+        blocks and title don't use, so that rendering the rest of the page
+        won't evaluate them. Otherwise, return context as it is.
+        """
+        if (not getattr(settings, 'DJPJ_LAZY_CONTEXT', False) or
+                not isinstance(self.context_data, dict) or
+                DJANGO_VERSION < (1, 8)):
+            return context
+        names = self._context_names(template)
+        if names is None:
+            return context
+        skipped = set(key for key, value in self.context_data.items()
+                      if key not in names and _is_lazy(value))
+        if not skipped:
+            return context
+        logger.debug("Left unused context out of PJAX response for %s: %s",
+                     self.template_name, ', '.join(sorted(skipped)))
+        if stats is not None:
+            stats.skipped_context = tuple(sorted(skipped))
+        return self._make_context(template, dict(
+            (k, v) for k, v in self.context_data.items() if k not in skipped))
+
+    def _block_names(self):
+        # A list of block names means a multi-fragment response.
+        block = self._djpj_block_name
+        return list(block) if isinstance(block, (list, tuple)) else [block]
+
+    def _target_blocks(self):
+        return [b for b in self._block_names() +
+                [self._djpj_title_block_name] if b]
+
+    @staticmethod
+    def _render_blocks(template, context, target_blocks, stats=None):
+        # If configured, try to render the blocks in isolation before falling
+        # back to rendering the whole template.
+        if getattr(settings, 'DJPJ_RENDER_BLOCKS_DIRECTLY', False):
+            try:
+                rendered_blocks = render_blocks_directly(
+                    template, context, target_blocks, stats)
+            except DirectRenderingUnsupported:
+                pass
+            else:
+                _set_mode(stats, 'direct')
+                return rendered_blocks
+        if getattr(settings, 'DJPJ_PATCH_TEMPLATES', True):
+            _set_mode(stats, 'patched')
+            with timer(stats, 'index'):
+                DjPjTemplate.patch(template)
+            return template.render_blocks(context, target_blocks, stats)
+        _set_mode(stats, 'unpatched')
+        return render_blocks_unpatched(template, context, target_blocks,
+                                       stats)
+
+    def _title_html(self, rendered_blocks, context):
+        """
+        Raise the appropriate error if any target block wasn't rendered or the
+        title variable is missing, otherwise return the PJAX <title> tag.
+        """
+        title_block = self._djpj_title_block_name
+        title_var = self._djpj_title_variable
 
-        # Get all our error handling out of the way before generating
-        # our PJAX-friendly output
         if None in rendered_blocks.values():
-            raise TemplateSyntaxError("Template block '%s' does not exist or was not rendered" % block)
+            missing = "', '".join(sorted(b for b, content in rendered_blocks.items()
+                                         if content is None))
+            raise TemplateSyntaxError("Template block '%s' does not exist or was not rendered" % missing)
         if title_var and title_var not in context:
             raise KeyError("PJAX title variable '%s' not found in context" % title_var)
 
-        # Return our PJAX response including a <title> tag if necessary
-        block_contents = rendered_blocks[block]
         title_contents = rendered_blocks.get(title_block, None) or context.get(title_var)
-        title_html = "<title>%s</title>\n" % title_contents if title_contents else ""
+        return "<title>%s</title>\n" % title_contents if title_contents else ""
+
+    @property
+    def rendered_content(self):
+        stats = self.djpj_stats
+        if stats is None:
+            return self._rendered_content(None)
+        try:
+            with stats.timer('total'):
+                content = self._rendered_content(stats)
+        except Exception as e:
+            stats.fail(self, e)
+            raise
+        stats.finish(self, content)
+        return content
+
+    def _rendered_content(self, stats):
+        """
+        Walk the template's node tree, casting our target blocks' nodelists to
+        PJAXBlockNodeList in order to store its output in the render context.
+        Then render the template as usual, but instead of returning the result,
+        return the captured output from our target block(s).
+        """
+
+        block = self._djpj_block_name
+
+        # If no block name is specified, assume we're rendering a PJAX-specific
+        # template, or a whole page, and just return the rendered output.
+        if not block:
+            request = getattr(self, '_request', None)
+            pjax = request is not None and is_pjax(request)
+            _set_mode(stats, 'template' if pjax else 'full')
+            with timer(stats, 'render'):
+                if self._djpj_slice_pages and not pjax:
+                    return self._render_sliceable_page()
+                return super(PJAXTemplateResponse, self).rendered_content
+
+        # If the fragment is cached, there's nothing more to do.
+        cache_key, fragment = self._cached_fragment()
+        if cache_key is not None:
+            if stats is not None:
+                stats.cache_hit = fragment is not None
+            if fragment is not None:
+                _set_mode(stats, 'cached')
+                return fragment
+
+        # Otherwise, render the fragment, unless an identical render is
+        # already in flight.
+        coalesce_key = self._coalesce_key()
+        if coalesce_key is None:
+            return self._render_fragment(cache_key, stats)
+        fragment, shared = in_flight.do(
+            coalesce_key, lambda: self._render_fragment(cache_key, stats),
+            getattr(settings, 'DJPJ_COALESCE_TIMEOUT', 10))
+        if shared:
+            _set_mode(stats, 'coalesced')
+        return fragment
+
+    def _render_fragment(self, cache_key, stats):
+        # Capture the output from the pjax block and, if specified, the title
+        # block or variable.
+        template, context = self._resolve_template_and_context()
+        context = self._without_unused_context(template, context, stats)
+        rendered_blocks = self._render_blocks(template, context,
+                                              self._target_blocks(), stats)
+        if stats is not None:
+            _count_nodes(template, context, self._target_blocks(), stats)
+
+        fragment = self._fragment(rendered_blocks, context)
+        if cache_key is not None:
+            self._djpj_fragment_cache.set(cache_key, fragment)
+        return fragment
+
+    def _fragment(self, rendered_blocks, context):
+        # Get all our error handling out of the way before generating
+        # our PJAX-friendly output, then return our PJAX response including
+        # a <title> tag if necessary
+        block = self._djpj_block_name
+        title_html = self._title_html(rendered_blocks, context)
+        if isinstance(block, (list, tuple)):
+            return title_html + frame_fragments(
+                (b, rendered_blocks[b]) for b in block)
+        return title_html + rendered_blocks[block]
+
+    def _render_sliceable_page(self):
+        """
+        Render the whole page, recording where each block's output is in it,
+        and store those offsets in the fragment cache, keyed on the page's
+        content, so that PJAX requests for its blocks can be answered by
+        slicing the copy of the page in Django's cache middleware's cache.
+        """
+        if (not self._caches_request() or DJANGO_VERSION < (1, 8) or
+                not isinstance(self.context_data, (dict, type(None))) or
+                not getattr(settings, 'DJPJ_PATCH_TEMPLATES', True)):
+            return super(PJAXTemplateResponse, self).rendered_content
+
+        template = self.resolve_template(self.template_name).template
+        DjPjTemplate.patch(template)
+        context = make_context(self.context_data, self._request)
+        context.djpj_page_blocks = page_blocks = PageBlocks()
+        content = template.render(context)
+
+        # The offsets of a page already rendered for another request are
+        # already stored.
+        page_key = page_cache_key(self.template_name,
+                                  content.encode(self.charset))
+        if (page_key is None or
+                self._djpj_fragment_cache.get(page_key) is not None):
+            return content
+
+        # The title variable is stored too, if it's known without rendering.
+        title_var = self._djpj_title_variable
+        title = None
+        if title_var and title_var in (self.context_data or {}):
+            title = u'%s' % self.context_data[title_var]
+        self._djpj_fragment_cache.set(page_key,
+                                      (page_blocks.offsets(content), title))
+        return content
+
+    def _sliced_fragment(self):
+        """
+        Return this response's fragment sliced out of the page cached by
+        Django's cache middleware for its URL, or None if there's no such
+        page, its offsets weren't stored by _render_sliceable_page(), or it
+        lacks a block or the title.
+        """
+        request = getattr(self, '_request', None)
+        page = cached_page(request) if request is not None else None
+        if page is None:
+            return None
+        content, charset = page
+        stored = self._djpj_fragment_cache.get(
+            page_cache_key(self.template_name, content))
+        if stored is None:
+            return None
+        offsets, title = stored
+        title_var = self._djpj_title_variable
+        if (title_var and title is None) or not all(
+                b in offsets for b in self._target_blocks()):
+            return None
+        content = content.decode(charset)
+        rendered_blocks = dict((b, content[offsets[b][0]:offsets[b][1]])
+                               for b in self._target_blocks())
+        return self._fragment(rendered_blocks,
+                              {title_var: title} if title_var else {})
+
+    def _coalesce_key(self):
+        """
+        Return the key identifying renders of the same fragment as this
+        response's, or None if its renders aren't coalesced. Like the
+        fragment cache, coalescing only applies to GET and HEAD requests.
+        """
+        if self._djpj_coalesce is None or not self._caches_request():
+            return None
+        user_key = self._djpj_coalesce(getattr(self, '_request', None))
+        if user_key is None:
+            return None
+        return fragment_cache_key(self.template_name, self._djpj_block_name,
+                                  self._djpj_title_block_name,
+                                  self._djpj_title_variable, user_key)
+
+    def _cached_fragment(self):
+        """
+        Return the key of this response's fragment in its fragment cache, and
+        the cached fragment or None, or (None, None) if it has no cache or its
+        request isn't a GET or HEAD request. The result is remembered, so that
+        the cache is only consulted once.
+        """
+        if self._djpj_cached_fragment is _unknown:
+            cache_key = fragment = None
+            fragment_cache = self._djpj_fragment_cache
+            if (fragment_cache is not None and self._djpj_block_name and
+                    self._caches_request()):
+                cache_key = fragment_cache_key(
+                    self.template_name, self._djpj_block_name,
+                    self._djpj_title_block_name, self._djpj_title_variable,
+                    self._user_cache_key())
+                if cache_key is not None:
+                    fragment = fragment_cache.get(cache_key)
+                if (fragment is None and cache_key is not None and
+                        self._djpj_slice_pages):
+                    fragment = self._sliced_fragment()
+            self._djpj_cached_fragment = cache_key, fragment
+        return self._djpj_cached_fragment
+
+    def _caches_request(self):
+        # As with Django's cache middleware, only responses to GET and HEAD
+        # requests are cached, or share renders with other responses.
+        request = getattr(self, '_request', None)
+        return request is None or request.method in ('GET', 'HEAD')
+
+    def _user_cache_key(self):
+        return self._djpj_fragment_cache_key(getattr(self, '_request', None))
+
+    def renders_from_cache(self):
+        """
+        Return True if this response's content will be taken from its fragment
+        cache, so that rendering it won't render any templates.
+        """
+        return self._cached_fragment()[1] is not None
+
+    def iter_rendered_content(self):
+        """
+        Generate the same content as rendered_content, but in pieces: the
+        <title> tag first, then the output of each top-level node in the block
+        as soon as it's rendered. Errors for a missing block or title variable
+        are raised before anything is generated.
+
+        This only makes a difference with DJPJ_RENDER_BLOCKS_DIRECTLY. When
+        blocks can't be rendered directly, several blocks are requested, or a
+        fragment cache or coalescing is in use, the whole response is
+        generated at once.
+        """
+        block = self._djpj_block_name
+        if (not block or self._djpj_fragment_cache is not None or
+                self._djpj_coalesce is not None or
+                isinstance(block, (list, tuple)) or
+                not getattr(settings, 'DJPJ_RENDER_BLOCKS_DIRECTLY', False)):
+            yield self.rendered_content
+            return
+
+        stats = self.djpj_stats
+        template, context = self._resolve_template_and_context()
+        target_blocks = self._target_blocks()
+        try:
+            state = _direct_render_state(template, context, target_blocks,
+                                         stats)
+            located = state.__enter__()
+        except DirectRenderingUnsupported:
+            yield self.rendered_content
+            return
+
+        # Only time the rendering itself, and not the time the consumer of
+        # this generator takes between chunks.
+        _set_mode(stats, 'direct')
+        size = 0
+        try:
+            with timer(stats, 'render'):
+                rendered_blocks = dict(
+                    (b, _render_block_in_place(node, ancestors, context))
+                    for b, (ancestors, node) in located.items() if b != block)
+                rendered_blocks[block] = ''
+                title_html = self._title_html(rendered_blocks, context)
+                ancestors, node = located[block]
+                chunks = _iter_block_in_place(node, ancestors, context)
+            chunk = title_html
+            while chunk is not None:
+                if stats is not None:
+                    size += len(force_bytes(chunk))
+                yield chunk
+                with timer(stats, 'render'):
+                    chunk = next(chunks, None)
+        except BaseException as e:
+            # Including GeneratorExit, when the generator is closed early.
+            if stats is not None and isinstance(e, Exception):
+                stats.fail(self, e)
+            if not state.__exit__(*sys.exc_info()):
+                raise
+        else:
+            state.__exit__(None, None, None)
+
+        if stats is not None:
+            _count_nodes(template, context, target_blocks, stats)
+            stats.fragment_size = size
+            stats.send(self)
+
+    def streaming_response(self):
+        """
+        Return a StreamingPJAXResponse which generates this response's content
+        with iter_rendered_content(), and carries the same status, headers and
+        cookies. Rendering starts immediately, so that errors are raised here
+        rather than once the response has started streaming to the client.
+        """
+        chunks = self.iter_rendered_content()
+        first_chunk = next(chunks)
+        response = StreamingPJAXResponse(_prepend(first_chunk, chunks),
+                                         status=self.status_code)
+        # Unless the whole response was rendered at once, a Server-Timing
+        # header can only report the time taken to render its first chunk.
+        stats = self.djpj_stats
+        if stats is not None and stats.fragment_size is None:
+            stats.add_server_timing(self)
+        for header, value in self.items():
+            response[header] = value
+        response.cookies = self.cookies
+        response.djpj_stats = stats
+        return response
+
+
+def _prepend(first_chunk, chunks):
+    # Unlike itertools.chain, a generator has a close() method, which Django
+    # calls when the response is closed, and which closes chunks in turn.
+    try:
+        yield first_chunk
+        for chunk in chunks:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+class StreamingPJAXResponse(StreamingHttpResponse):
+    """
+    A streaming response, returned in place of a PJAXTemplateResponse when
+    pjax_block is passed stream=True. It's already rendered, but provides a
+    render() method since DjangoPJAXMiddleware may substitute it for a
+    TemplateResponse in template response middleware, after which Django
+    calls render().
+    """
+
+    is_rendered = True
 
-        return title_html + block_contents
+    def render(self):
+        return self
@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+
+from django import template
+from django.template.loader_tags import BlockNode
+
+from djpj.compat import format_html
+from djpj.template import layout_version, rendering_blocks
+
+register = template.Library()
+
+
+class PjaxSkipNode(template.Node):
+    """
+    Renders its contents for whole pages, and nothing while blocks are being
+    rendered for a PJAX response.
+    """
+
+    # Tells DjPj's context analysis that nothing in here is rendered.
+    djpj_skipped = True
+
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        if rendering_blocks(context):
+            return ''
+        return self.nodelist.render(context)
+
+
+@register.tag
+def pjax_skip(parser, token):
+    """
+    Mark a region of a template that PJAX responses don't need, so that it's
+    not rendered while DjPj renders the template's blocks:
+
+        {% pjax_skip %}{% expensive_sidebar %}{% endpjax_skip %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 1:
+        raise template.TemplateSyntaxError(
+            "'%s' takes no arguments" % bits[0])
+    nodelist = parser.parse(('endpjax_skip',))
+    parser.delete_first_token()
+    return PjaxSkipNode(nodelist)
+
+
+class PjaxLazyNode(BlockNode):
+    """
+    A block which, instead of its contents, renders a placeholder that DjPj's
+    client script replaces with the block, fetched with a request of its own.
+    The contents are rendered when that request renders the block, or when
+    there's no request to fetch it with.
+    """
+
+    def render(self, context):
+        request = getattr(context, 'request', None)
+        if request is None or self.name in rendering_blocks(context):
+            return super(PjaxLazyNode, self).render(context)
+        return format_html(u'<div data-djpj-lazy="{0}" data-djpj-url="{1}">'
+                           u'</div>', self.name, request.get_full_path())
+
+
+@register.tag
+def pjax_lazy(parser, token):
+    """
+    Define a block, which can be overridden like any other, whose contents
+    are fetched by DjPj's client script after the rest of the page:
+
+        {% pjax_lazy "recommendations" %}...{% endpjax_lazy %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(
+            "'%s' takes one argument, the name of the block" % bits[0])
+    block_name = bits[1]
+    if block_name[0] in ('"', "'") and block_name[-1] == block_name[0]:
+        block_name = block_name[1:-1]
+    # Share {% block %}'s check for blocks with the same name.
+    try:
+        if block_name in parser.__loaded_blocks:
+            raise template.TemplateSyntaxError(
+                "'%s' tag with name '%s' appears more than once"
+                % (bits[0], block_name))
+        parser.__loaded_blocks.append(block_name)
+    except AttributeError:
+        parser.__loaded_blocks = [block_name]
+    nodelist = parser.parse(('endpjax_lazy',))
+    parser.delete_first_token()
+    return PjaxLazyNode(block_name, nodelist)
+
+
+@register.simple_tag(takes_context=True)
+def pjax_version(context):
+    """
+    Render a <meta> tag giving jquery-pjax the layout version of the template
+    being rendered, as sent in the X-PJAX-Version header of PJAX responses
+    with the DJPJ_PJAX_VERSION setting. Put it in the <head> of your base
+    template.
+    """
+    template = getattr(context, 'template', None)
+    version = template and layout_version(template, context.flatten())
+    if not version:
+        return ''
+    return format_html(u'<meta http-equiv="x-pjax-version" content="{0}">',
+                       version)
@@ -1,15 +1,22 @@
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import partial
 import re
+import threading
+
+from djpj.compat import setting_changed
+
+try:
+    from django.utils.autoreload import file_changed as _file_changed
+except ImportError:
+    _file_changed = None
 
 
 # The container passed by pjax should be a simple id selector e.g. "#main"
 _container_re = re.compile(r'^#\S+$')
 
 
-def pjax_container(request):
-    """Return the name of the pjax container specified by the given request."""
-    container = request.META['HTTP_X_PJAX_CONTAINER']
+def _container_name(container):
     if _container_re.match(container):
         return container[1:]
     else:
@@ -18,6 +25,111 @@ def pjax_container(request):
                          % container)
 
 
+def pjax_container(request):
+    """Return the name of the pjax container specified by the given request."""
+    return _container_name(request.META['HTTP_X_PJAX_CONTAINER'])
+
+
+def pjax_containers(request):
+    """
+    Return a list of the names of the containers listed in the request's
+    X-DjPj-Containers header, which DjPj's client script sends to update
+    several containers with one request. Without that header, return the name
+    of the single pjax container, as pjax_container does.
+    """
+    containers = request.META.get('HTTP_X_DJPJ_CONTAINERS')
+    if containers is None:
+        return pjax_container(request)
+    return [_container_name(c.strip()) for c in containers.split(',')
+            if c.strip()]
+
+
+def pjax_lazy_block(request):
+    """
+    Return the name of the {% pjax_lazy %} block requested with the request's
+    X-DjPj-Lazy header, which DjPj's client script sends to fill in the block's
+    placeholder, or None.
+    """
+    name = request.META.get('HTTP_X_DJPJ_LAZY', '').strip()
+    return name or None
+
+
+# Each fragment in a multi-fragment response is preceded by a comment holding
+# its name and its length in UTF-16 code units, as measured by Javascript.
+_fragment_frame_re = re.compile(r'<!--djpj-fragment (\S+) (\d+)-->')
+
+
+def _js_length(s):
+    return len(s.encode('utf-16-le')) // 2
+
+
+def frame_fragments(fragments):
+    """
+    Join a sequence of (name, html) pairs into the body of a multi-fragment
+    PJAX response, from which split_fragments (or DjPj's client script) can
+    recover them.
+    """
+    return ''.join('<!--djpj-fragment %s %d-->%s' % (name, _js_length(html), html)
+                   for name, html in fragments)
+
+
+def split_fragments(body):
+    """
+    Split the body of a multi-fragment PJAX response into the content before
+    the first fragment (such as a <title> tag) and a list of (name, html)
+    pairs.
+
+    >>> split_fragments(frame_fragments([('a', 'one'), ('b', 'two')]))
+    ('', [('a', 'one'), ('b', 'two')])
+    """
+    fragments = []
+    match = _fragment_frame_re.search(body)
+    prefix = body[:match.start()] if match else body
+    while match:
+        name, length = match.group(1), int(match.group(2))
+        # Slice by UTF-16 length, to match the length recorded in the frame.
+        encoded = body[match.end():].encode('utf-16-le')
+        html = encoded[:length * 2].decode('utf-16-le')
+        fragments.append((name, html))
+        match = _fragment_frame_re.match(body, match.end() + len(html))
+    return prefix, fragments
+
+
+# Each item in a batch response is preceded by a comment holding its status
+# code, its URL and its length, measured as for fragments.
+_item_frame_re = re.compile(r'<!--djpj-item (\d{3}) (\S+) (\d+)-->')
+
+
+def frame_items(items):
+    """
+    Join a sequence of (status, url, html) triples into the body of a response
+    from DjPj's batch view, from which split_items (or DjPj's client script)
+    can recover them.
+    """
+    return ''.join('<!--djpj-item %d %s %d-->%s'
+                   % (status, url, _js_length(html), html)
+                   for status, url, html in items)
+
+
+def split_items(body):
+    """
+    Split the body of a response from DjPj's batch view into a list of
+    (status, url, html) triples.
+
+    >>> split_items(frame_items([(200, '/a/', 'one'), (404, '/b/', '')]))
+    [(200, '/a/', 'one'), (404, '/b/', '')]
+    """
+    items = []
+    match = _item_frame_re.match(body)
+    while match:
+        length = int(match.group(3))
+        encoded = body[match.end():].encode('utf-16-le')
+        html = encoded[:length * 2].decode('utf-16-le')
+        items.append((int(match.group(1)), match.group(2), html))
+        match = _item_frame_re.match(body, match.end() + len(html))
+    return items
+
+
 def pjaxify_template_path(template_path, container=None):
     """
     Take a template path and optionally a container, and return the path with
@@ -108,3 +220,110 @@ def strip_pjax_parameter(request):
                 del get['_pjax']
             request.META['QUERY_STRING'] = \
                 strip_pjax_qs_parameter(request.META['QUERY_STRING'])
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping which holds at most maxsize items, discarding the
+    least recently used item to make room for a new one. If timeout is given,
+    items also expire that many seconds after they're set.
+    """
+
+    def __init__(self, maxsize=1024, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiry, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expiry is not None and expiry <= _now():
+                return default
+            self._data[key] = expiry, value
+            return value
+
+    def set(self, key, value):
+        expiry = None if self.timeout is None else _now() + self.timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = expiry, value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+try:
+    from time import monotonic as _now
+except ImportError:
+    from time import time as _now
+
+
+# (using, template name) pairs known not to exist, for select_existing_template.
+missing_templates = LRUCache(1024)
+
+
+def select_existing_template(template_names, using=None):
+    """
+    Return the first of the named templates that exists, like Django's
+    select_template, but remembering which names don't exist so that they're
+    never looked for again. pjax_template uses this, since most of the
+    PJAX-specific template names it tries are usually missing.
+
+    The names remembered are forgotten when Django's autoreloader sees a file
+    change or the template settings are changed. In DEBUG mode, under versions
+    of Django without the autoreloader's file_changed signal, nothing is
+    remembered.
+    """
+    from django.template import TemplateDoesNotExist
+    from django.template.loader import get_template, select_template
+
+    remember = remembering_templates()
+    for name in template_names:
+        if missing_templates.get((using, name)):
+            continue
+        try:
+            return get_template(name, using=using)
+        except TemplateDoesNotExist:
+            if remember:
+                missing_templates.set((using, name), True)
+
+    # Raise the error Django would, listing every name tried.
+    return select_template(template_names, using=using)
+
+
+def remembering_templates():
+    """
+    Return True if templates found by DjPj may be remembered until the
+    template settings change or the autoreloader sees a file change. Under
+    versions of Django without the autoreloader's file_changed signal, that's
+    only when DEBUG is off.
+    """
+    from django.conf import settings
+    return not settings.DEBUG or _file_changed is not None
+
+
+# Caches of what DjPj has learned about templates, cleared whenever templates
+# may have changed.
+template_caches = [missing_templates]
+
+
+def _forget_templates(**kwargs):
+    if kwargs.get('setting', 'TEMPLATES') in ('TEMPLATES', 'TEMPLATE_DIRS',
+                                              'TEMPLATE_LOADERS'):
+        for cache in template_caches:
+            cache.clear()
+
+
+setting_changed.connect(_forget_templates)
+if _file_changed is not None:
+    _file_changed.connect(_forget_templates)
@@ -0,0 +1,143 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotAllowed)
+from django.utils import translation
+
+try:
+    from django.urls import (get_script_prefix, get_urlconf,
+                             set_script_prefix, set_urlconf)
+except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import (get_script_prefix, get_urlconf,
+                                          set_script_prefix, set_urlconf)
+
+from djpj.dispatch import call_view, internal_request
+from djpj.metrics import registry
+from djpj.utils import frame_items
+
+logger = logging.getLogger('djpj')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def metrics(request):
+    """
+    Return the metrics DjPj has recorded in this process, in Prometheus' text
+    format. Record metrics by setting DJPJ_METRICS = True.
+    """
+    return HttpResponse(registry.prometheus_text(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def batch(request):
+    """
+    Answer PJAX requests for several pages with one response, so that the
+    client pays for the round trip of a request once for all of them. Each
+    item is given as a "path" and "container" query parameter, in order:
+
+        /djpj/batch/?path=/products/hat/&container=main&path=...
+
+    Each path's view is called directly with a PJAX request for the
+    container, made from a copy of this request, so that the project's
+    middleware only processes the batch request, and each item shares its
+    session and user. The result is framed with djpj.utils.frame_items,
+    giving each item's status code and URL.
+
+    Only views decorated with pjax_block or pjax_template, or matched by
+    DJPJ_PJAX_URLS, are called; other paths get a 404 status.
+
+    At most DJPJ_BATCH_MAX_ITEMS (20 by default) items are accepted. If
+    DJPJ_BATCH_THREADS is set, items are rendered on a pool of that many
+    threads, rather than one after another.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    paths = request.GET.getlist('path')
+    containers = request.GET.getlist('container')
+    if len(paths) != len(containers):
+        return HttpResponseBadRequest("Each path needs a container.")
+    if len(paths) > getattr(settings, 'DJPJ_BATCH_MAX_ITEMS', 20):
+        return HttpResponseBadRequest("Too many items.")
+
+    items = list(zip(paths, containers))
+    threads = getattr(settings, 'DJPJ_BATCH_THREADS', 0)
+    if threads and len(items) > 1:
+        results = _batch_executor(threads).map(
+            _in_request_thread_state(_render_item),
+            [(request, path, container) for path, container in items])
+    else:
+        results = [_render_item((request, path, container))
+                   for path, container in items]
+    return HttpResponse(frame_items(results),
+                        content_type='text/html; charset=utf-8')
+
+
+def _batch_executor(threads):
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _executor = ThreadPoolExecutor(
+                    max_workers=threads, thread_name_prefix='djpj-batch')
+    return _executor
+
+
+def _in_request_thread_state(fn):
+    # Carry the thread-local state that views may rely on - the script
+    # prefix, URLconf and active language - over to the worker threads.
+    from django.db import close_old_connections
+
+    prefix, urlconf = get_script_prefix(), get_urlconf()
+    language = translation.get_language()
+
+    def run(args):
+        set_script_prefix(prefix)
+        set_urlconf(urlconf)
+        try:
+            with translation.override(language):
+                return fn(args)
+        finally:
+            close_old_connections()
+    return run
+
+
+def _render_item(args):
+    """Return the (status, url, html) triple for an item of a batch."""
+    request, path, container = args
+    try:
+        item_request = internal_request(request, path, container)
+    except ValueError:
+        return 400, _frame_url(path), ''
+    try:
+        # Only DjPj's views are served, since others' pages aren't fragments.
+        response = call_view(item_request)
+    except Http404:
+        return 404, _frame_url(path), ''
+    except PermissionDenied:
+        return 403, _frame_url(path), ''
+    except Exception:
+        logger.exception("Error rendering batch item %s", path)
+        return 500, _frame_url(path), ''
+    if response is None:
+        return 404, _frame_url(path), ''
+    if response.status_code >= 400:
+        return response.status_code, _frame_url(path), ''
+
+    if getattr(response, 'streaming', False):
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+    url = (response.get('X-PJAX-URL') or response.get('Location') or
+           item_request.get_full_path())
+    return (response.status_code, _frame_url(url),
+            content.decode(response.charset))
+
+
+def _frame_url(url):
+    # URLs in item frames can't be empty or contain spaces.
+    return url.replace(' ', '%20') or '-'
@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context
+from django.template.loader import get_template
+
+from djpj.compat import string_types
+from djpj.template import BlockIndex, constant_parent_name, parent_template
+
+
+def warm_up(templates=None, pjax_urls=None):
+    """
+    Do the work DjPj would otherwise do on the first requests for a template,
+    so that errors surface immediately and the first requests are as fast as
+    any other. Each template is compiled along with the templates it extends,
+    their blocks are indexed, and the middleware's decorators are parsed.
+
+    templates defaults to the DJPJ_WARMUP_TEMPLATES setting: a sequence of
+    template names, or of (template name, block names) pairs, in which case
+    ImproperlyConfigured is raised if a block isn't found in the template or
+    the templates it extends. pjax_urls defaults to DJPJ_PJAX_URLS.
+
+    Returns a list of inheritance chains, each a list of template names
+    starting with a warmed-up template and ending with its root template.
+    """
+    from djpj.middleware import DjangoPJAXMiddleware
+
+    if templates is None:
+        templates = getattr(settings, 'DJPJ_WARMUP_TEMPLATES', ())
+    if pjax_urls is None:
+        pjax_urls = getattr(settings, 'DJPJ_PJAX_URLS', ())
+    DjangoPJAXMiddleware.parse_configuration(pjax_urls)
+
+    chains = []
+    for entry in templates:
+        if isinstance(entry, string_types):
+            template_name, block_names = entry, ()
+        else:
+            template_name, block_names = entry
+        if isinstance(block_names, string_types):
+            block_names = (block_names,)
+
+        chain = _inheritance_chain(template_name)
+        found_blocks = set()
+        for template in chain:
+            found_blocks.update(BlockIndex.for_template(template).all_blocks)
+        for block_name in block_names:
+            if block_name not in found_blocks:
+                raise ImproperlyConfigured(
+                    "Block '%s' isn't defined in template '%s' or the "
+                    "templates it extends." % (block_name, template_name))
+        chains.append([_template_name(t) for t in chain])
+    return chains
+
+
+def _inheritance_chain(template_name):
+    # Follow the template's {% extends %} tags for as long as they name their
+    # parent with a constant, since a variable's value can't be known yet.
+    template = get_template(template_name)
+    chain = [getattr(template, 'template', template)]
+    # ExtendsNode finds the template engine through the context's template.
+    context = Context()
+    context.template = chain[0]
+    extends_node = BlockIndex.for_template(chain[0]).extends_node
+    while (extends_node is not None and
+           constant_parent_name(extends_node) is not None):
+        chain.append(parent_template(extends_node, context))
+        extends_node = BlockIndex.for_template(chain[-1]).extends_node
+    return chain
+
+
+def _template_name(template):
+    origin = getattr(template, 'origin', None)
+    return (getattr(origin, 'template_name', None) or
+            getattr(template, 'name', None) or repr(template))
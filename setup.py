@@ -19,6 +19,7 @@ setup(
     author_email='alex@hill.net.au',
 
     packages=find_packages(),
+    include_package_data=True,
     install_requires=['django>=1.4'],
     tests_require=['nose'],
 
@@ -32,7 +33,6 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.3',
@@ -1,23 +1,53 @@
 import django
+import threading
+import time
+from contextlib import contextmanager
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
-from django.http import HttpResponseRedirect, HttpResponse
-from django.template import Template, TemplateSyntaxError
+from django.core.management import call_command
+from django.http import (HttpResponseForbidden, HttpResponseRedirect,
+                         HttpResponse)
+from django.template import (Context, Engine, NodeList, Template,
+                             TemplateDoesNotExist, TemplateSyntaxError)
+from django.template.loader_tags import ExtendsNode
 from django.template.response import TemplateResponse
+from django.test.signals import setting_changed
+from django.test.utils import override_settings
+from django.views.decorators.cache import cache_page
 
 import pytest
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import djpj.template
+from djpj.cache import LocalFragmentCache, fragment_cache_key
+from djpj.coalesce import SingleFlight, in_flight
 from djpj.decorator import pjax_block, pjax_template
-from djpj.middleware import DjangoPJAXMiddleware
+from djpj.management.commands import djpj_warmup
+from djpj.metrics import MetricsRegistry, registry
+from djpj.middleware import DjangoPJAXMiddleware, URLDispatcher
+from djpj.signals import response_rendered
 from djpj.template import PJAXTemplateResponse
 from djpj.utils import *
+from djpj.views import batch, metrics
+from djpj.warmup import warm_up
 
 settings.configure()
 
-# This import has to go after settings.configure() in Django < 1.7
+# These imports have to go after settings.configure()
+from django.contrib import messages  # noqa
+from django.contrib.messages.storage.base import BaseStorage  # noqa
 from django.test.client import RequestFactory  # noqa
 
+try:
+    from django.urls import re_path
+except ImportError:  # Django < 2.0
+    from django.conf.urls import url as re_path
+
 if django.VERSION >= (1, 7):
     django.setup()
 
@@ -117,6 +147,41 @@ def test_pjax_template_auto():
     assert resp.template_name == ('test_template-pjax=secondary.html', 'test_template.html')
 
 
+def test_pjax_template_skips_missing_templates():
+    missing_templates.clear()
+    view = pjax_template()(base_view)
+    content = view(pjax_request, 'test_template.html').render().content
+    assert content == b"outside of block file base block content"
+    assert missing_templates.get((None, 'test_template-pjax=secondary.html'))
+
+    names = ['test_template-pjax=secondary.html', 'missing.html']
+    with pytest.raises(TemplateDoesNotExist) as excinfo:
+        select_existing_template(names)
+    assert 'test_template-pjax=secondary.html' in str(excinfo.value)
+
+    setting_changed.send(sender=None, setting='TEMPLATES', value=None, enter=True)
+    assert len(missing_templates) == 0
+
+
+@pytest.mark.skipif(django.VERSION < (1, 8), reason="requires template engines")
+def test_warm_up():
+    chains = warm_up(['test_template.html',
+                      ('test_extends_template.html', ['main'])],
+                     (('^/', '@pjax_block("main")'),))
+    assert chains == [['test_template.html'],
+                      ['test_extends_template.html', 'test_template.html']]
+
+    with pytest.raises(ImproperlyConfigured):
+        warm_up([('test_extends_template.html', 'sidebar')], ())
+    with pytest.raises(ImproperlyConfigured):
+        warm_up([], (('^/', 'pjax_block()'),))
+
+    out = StringIO()
+    with override_settings(DJPJ_WARMUP_TEMPLATES=['test_extends_template.html']):
+        call_command(djpj_warmup.Command(), stdout=out)
+    assert 'test_extends_template.html -> test_template.html' in out.getvalue()
+
+
 def test_pjax_block_no_result():
     resp = pjax_block(lambda *a, **kw: None)(base_view)(pjax_request, test_template)
     result = resp.rendered_content
@@ -284,6 +349,46 @@ def test_middleware_configuration():
                                          'Some secondary content.')
 
 
+def test_url_dispatcher():
+    regexes = [re.compile(r) for r in (r'^/shop/', r'^/shop/(?P<slug>\w+)/$',
+                                       r'^/blog/')]
+    dispatcher = URLDispatcher(regexes)
+    assert dispatcher.combined_regex is not None
+    assert dispatcher.match('/shop/') == (0,)
+    assert dispatcher.match('/shop/hat/') == (0, 1)
+    assert dispatcher.match('/blog/shop/') == (2,)
+    assert dispatcher.match('/elsewhere/') == ()
+    assert dispatcher.match('/shop/hat/') == (0, 1)
+
+    # Patterns that can't be combined are matched one by one.
+    uncombinable = regexes + [re.compile(r'(?i)^/about/'),
+                              re.compile(r'^/(\w)\1/')]
+    dispatcher = URLDispatcher(uncombinable)
+    assert dispatcher.combined_regex is None
+    assert dispatcher.match('/ABOUT/') == (3,)
+    assert dispatcher.match('/shop/hat/') == (0, 1)
+    assert dispatcher.match('/zz/') == (4,)
+
+
+def test_middleware_non_pjax_request():
+    middleware = DjangoPJAXMiddleware((('^/', '@pjax_block()'),))
+    response = middleware.process_template_response(
+        regular_request, base_view(regular_request, test_template))
+    assert 'X-PJAX-Container' in response['Vary']
+    assert not isinstance(response, PJAXTemplateResponse)
+    assert middleware.process_template_response(regular_request, response) \
+        is response
+
+
+def test_decorator_process_response():
+    process_response = pjax_block("main").process_response
+    response = process_response(pjax_request,
+                                base_view(pjax_request, test_template))
+    assert response.rendered_content == "I'm wearing orange galoshes"
+    assert response['X-PJAX-URL'] == pjax_request.get_full_path()
+    assert 'X-PJAX-Container' in response['Vary']
+
+
 def test_middleware_invalid_decorator():
 
     decorator_mistakes = (
@@ -293,7 +398,9 @@ def test_middleware_invalid_decorator():
         '@pjax_block(*["main"])',  # Using star args
         '@pjax_block(**{block: "main"})',  # Using kwargs
         '@pjax_block("main_"[:-1])',  # Not a string
-        '@pjax_block(block="main_"[:-1])'  # Not a string
+        '@pjax_block(block="main_"[:-1])',  # Not a string
+        '@pjax_block(etag=1)',  # Not a string or constant
+        '@pjax_block(["main", 1])',  # Not a list of strings
     )
 
     for decorator in decorator_mistakes:
@@ -351,6 +458,1102 @@ def test_registry():
     assert wrapped_classes == ['ExtendsNode', 'NodeList', 'Template', 'TemplateResponse']
 
 
+def test_block_index():
+    index = djpj.template.BlockIndex.for_template(test_template.template)
+    assert sorted(index.blocks) == ['main', 'secondary', 'title']
+    assert [type(n).__name__ for n in index.paths['main']] == ['WithNode']
+    assert index.paths['title'] == ()
+    assert index.extends_nodes == []
+    assert djpj.template.BlockIndex.for_template(test_template.template) is index
+
+    extends_index = djpj.template.BlockIndex.for_template(extends_template.template)
+    assert len(extends_index.extends_nodes) == 1
+    assert isinstance(extends_index.paths['secondary'][0], ExtendsNode)
+
+
+def test_block_index_reloaded_template():
+    if django.VERSION < (1, 9):
+        pytest.skip("Templates have no loader-aware origin before Django 1.9")
+    first = template_backend.get_template(file_template).template
+    for loader in template_backend.engine.template_loaders:
+        if hasattr(loader, 'reset'):
+            loader.reset()
+    second = template_backend.get_template(file_template).template
+    assert first is not second
+    assert first.origin.name == second.origin.name
+    first_index = djpj.template.BlockIndex.for_template(first)
+    second_index = djpj.template.BlockIndex.for_template(second)
+    assert first_index is not second_index
+    assert second_index.blocks['main'] is second.nodelist[1]
+
+
+def test_parent_templates_remembered():
+    if django.VERSION < (1, 9):
+        pytest.skip("Recursive extends is supported from Django 1.9")
+    locmem = 'django.template.loaders.locmem.Loader'
+    engine = Engine(loaders=[
+        (locmem, {'page.html': '{% extends "base.html" %}'
+                               '{% block main %}page{% endblock %}',
+                  'base.html': '{% extends "base.html" %}'
+                               '{% block main %}{{ block.super }}!{% endblock %}'}),
+        (locmem, {'base.html': '{% block main %}base{% endblock %}'})])
+
+    def context_for(template):
+        context = Context()
+        context.template = template
+        return context
+
+    def chain(name):
+        template = engine.get_template(name)
+        return djpj.template._resolve_inheritance_chain(
+            template, context_for(template))
+
+    page, base, root_base = chain('page.html')
+    assert [t.origin.loader for t in (base, root_base)] == \
+        list(engine.template_loaders)
+    # The locmem loader returns a new template every time, but the parent of
+    # page.html's {% extends %} tag is only looked up once.
+    extends_node = djpj.template.BlockIndex.for_template(page).extends_node
+    parent_template = djpj.template.parent_template
+    assert parent_template(extends_node, context_for(page)) is base
+    # The recursive {% extends "base.html" %} is always looked up.
+    assert chain('base.html')[1].origin.loader is engine.template_loaders[1]
+
+    setting_changed.send(sender=None, setting='TEMPLATES', value=None, enter=True)
+    assert parent_template(extends_node, context_for(page)) is not base
+
+
+def render_directly(template, blocks, context_data=None):
+    context = Context(dict(context_data or {}, colour="orange"))
+    return djpj.template.render_blocks_directly(template, context, blocks)
+
+
+def test_render_blocks_directly():
+    assert render_directly(test_template.template, ['main', 'title']) == {
+        'main': "I'm wearing orange galoshes", 'title': "Block Title"}
+
+
+def test_render_blocks_directly_extends():
+    context = {'base_template': base_template}
+    assert render_directly(extends_template.template, ['main', 'secondary'],
+                           context) == {
+        'main': "base block content",
+        'secondary': "overridden secondary block content"}
+
+
+def test_render_blocks_directly_nested_override():
+    base = Template("{% block outer %}[{% block inner %}base{% endblock %}]"
+                    "{% endblock %}{% block other %}{% endblock %}")
+    child = Template("{% extends base %}{% block outer %}"
+                     "{% with word='child' %}{% block new %}{{ word }}"
+                     "{% endblock %}{% endwith %}{% endblock %}")
+    assert render_directly(child, ['new'], {'base': base}) == {'new': 'child'}
+    with pytest.raises(djpj.template.DirectRenderingUnsupported):
+        render_directly(child, ['inner'], {'base': base})
+
+
+def test_render_blocks_directly_unsupported():
+    conditional = Template("{% if True %}{% block main %}{% endblock %}{% endif %}")
+    assigned = Template("{% firstof 'a' as b %}{% block main %}{% endblock %}")
+    nested = Template("{% if True %}{% firstof 'a' as b %}{% endif %}"
+                      "{% block main %}[{{ b }}]{% endblock %}")
+    for template in (conditional, assigned, nested):
+        with pytest.raises(djpj.template.DirectRenderingUnsupported):
+            render_directly(template, ['main'])
+
+    # Assignments scoped to a {% with %} tag are no obstacle.
+    scoped = Template("{% with a=1 %}{% firstof 'a' as b %}{% endwith %}"
+                      "{% block main %}[{{ b }}]{% endblock %}")
+    assert render_directly(scoped, ['main']) == {'main': '[]'}
+
+    view = pjax_block("main")(base_view)
+    with override_settings(DJPJ_RENDER_BLOCKS_DIRECTLY=True):
+        response = view(pjax_request, DjangoTemplate(nested, template_backend))
+        assert response.rendered_content == "[a]"
+
+
+def test_pjax_block_rendered_directly():
+    calls = []
+    template = DjangoTemplate(Template(
+        "{{ expensive }}{% if True %}{% block other %}{% endblock %}{% endif %}"
+        "{% block main %}{{ colour }}{% endblock %}"), template_backend)
+    context = {'expensive': lambda: calls.append(1)}
+    view = pjax_block("main")(base_view)
+    with override_settings(DJPJ_RENDER_BLOCKS_DIRECTLY=True):
+        assert view(pjax_request, template, context).rendered_content == "orange"
+        assert calls == []
+        view_other = pjax_block("other")(base_view)
+        assert view_other(pjax_request, template, context).rendered_content == ""
+        assert calls == [1]
+
+
+def test_render_blocks_unpatched():
+    base = Template("{% block main %}base {{ colour }}{% endblock %}"
+                    "{% block secondary %}base secondary{% endblock %}")
+    child = Template("{% extends base %}"
+                     "{% block secondary %}child {{ block.super }}{% endblock %}")
+    standalone = Template("{% with a='b' %}{% block main %}{{ a }}"
+                          "{% endblock %}{% endwith %}")
+    render = djpj.template.render_blocks_unpatched
+    context = lambda: Context({'base': base, 'colour': 'orange'})
+    assert render(child, context(), ['main', 'secondary']) == {
+        'main': "base orange", 'secondary': "child base secondary"}
+    assert render(standalone, context(), ['main']) == {'main': "b"}
+    assert render(standalone, context(), ['missing']) == {'missing': None}
+    for template in (base, child, standalone):
+        assert type(template) is Template
+        assert all(type(node.nodelist) is NodeList for node in
+                   djpj.template.BlockIndex.for_template(template).blocks.values())
+
+
+def test_unpatched_concurrent_renders():
+    base = DjangoTemplate(Template(
+        "<head>{% block title %}{{ title }}{% endblock %}</head>"
+        "{% for i in items %}{{ i }}{% endfor %}"
+        "{% block main %}base {{ colour }}{% endblock %}"
+        "{% block secondary %}base secondary{% endblock %}"), template_backend)
+    child = DjangoTemplate(Template(
+        "{% extends base %}"
+        "{% block secondary %}child {{ block.super }} {{ n }}{% endblock %}"),
+        template_backend)
+    expected_full = ("<head>title %d</head>0123456789base orange"
+                     "child base secondary %d")
+    views = {
+        'main': (pjax_block("main")(base_view), "base orange"),
+        'secondary': (pjax_block("secondary", title_block="title")(base_view),
+                      "<title>title %d</title>\nchild base secondary %d"),
+        None: (pjax_block("main")(base_view), expected_full),
+    }
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(50):
+                block = (None, 'main', 'secondary')[(n + i) % 3]
+                view, expected = views[block]
+                request = regular_request if block is None else pjax_request
+                context = {'base': base, 'title': 'title %d' % n, 'n': n,
+                           'items': range(10)}
+                result = view(request, child, context).rendered_content
+                expected = expected.replace('%d', str(n))
+                if result != expected:
+                    errors.append((block, result, expected))
+        except Exception as e:
+            errors.append(e)
+
+    with override_settings(DJPJ_PATCH_TEMPLATES=False):
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    for template in (base.template, child.template):
+        assert type(template) is Template
+        assert not hasattr(template, '_djpj_initialised_blocks')
+    assert type(child.template.nodelist[0]) is ExtendsNode
+
+
+def test_lazy_context():
+    template = DjangoTemplate(Template(
+        "{% for item in sidebar %}{{ item }}{% endfor %}{{ header.title }}"
+        "{% block title %}{{ page_title|default:fallback }}{% endblock %}"
+        "{% with shoe=footwear %}{% block main %}"
+        "{% if show %}{{ colour }} {{ shoe }}{% endif %}{% endblock %}{% endwith %}"),
+        template_backend)
+    evaluated = []
+
+    def expensive(name):
+        def evaluate():
+            evaluated.append(name)
+            return [name]
+        return evaluate
+
+    context_data = {"sidebar": expensive("sidebar"), "header": expensive("header"),
+                    "footwear": expensive("footwear"), "show": expensive("show"),
+                    "colour": "orange", "fallback": "Title"}
+    view = pjax_block("main", title_block="title")(TemplateResponse)
+    received = []
+
+    def receiver(sender, stats, **kwargs):
+        received.append(stats)
+
+    response_rendered.connect(receiver)
+    try:
+        with override_settings(DJPJ_LAZY_CONTEXT=True):
+            response = view(pjax_request, template, dict(context_data))
+            assert response.rendered_content == \
+                "<title>Title</title>\norange [&#x27;footwear&#x27;]"
+    finally:
+        response_rendered.disconnect(receiver)
+    assert sorted(evaluated) == ['footwear', 'show']
+    assert received[0].skipped_context == ('header', 'sidebar')
+
+    # Nothing is left out if the block includes another template.
+    template = DjangoTemplate(Template(
+        "{{ header }}{% block main %}{% include included %}{% endblock %}"),
+        template_backend)
+    del evaluated[:]
+    with override_settings(DJPJ_LAZY_CONTEXT=True):
+        pjax_block("main")(TemplateResponse)(
+            pjax_request, template, {"header": expensive("header"),
+                                     "included": file_template}).render()
+    assert evaluated == ['header']
+
+
+context_processor_calls = []
+
+
+def menu_processor(request):
+    context_processor_calls.append('menu')
+    return {'menu': 'Menu'}
+
+
+def colour_processor(request):
+    context_processor_calls.append('colour')
+    return {'colour': 'orange'}
+
+
+def cart_processor(request):
+    context_processor_calls.append('cart')
+    cart = request.META.get('HTTP_X_CART')
+    return {'cart': cart} if cart else {}
+
+
+def test_pjax_block_context_processors():
+    engine = Engine(context_processors=['tests.menu_processor',
+                                        'tests.colour_processor'])
+    template = DjangoTemplate(Template(
+        "{{ menu }}{% block main %}{{ colour }}{% endblock %}", engine=engine),
+        template_backend)
+
+    def render(**kwargs):
+        del context_processor_calls[:]
+        view = pjax_block("main", **kwargs)(TemplateResponse)
+        return view(pjax_request, template, {}).rendered_content
+
+    assert render() == "orange"
+    assert context_processor_calls == ['menu', 'colour']
+    assert render(context_processors=['tests.colour_processor']) == "orange"
+    assert context_processor_calls == ['colour']
+    assert render(context_processors=[]) == ""
+    assert context_processor_calls == []
+
+    # Automatic selection runs each processor until it's seen to be unused.
+    assert render(context_processors='auto') == "orange"
+    assert render(context_processors='auto') == "orange"
+    assert context_processor_calls == ['colour']
+
+    # A processor that provided nothing isn't known to be unused.
+    engine = Engine(context_processors=['tests.cart_processor'])
+    template = DjangoTemplate(Template(
+        "{% block main %}[{{ cart }}]{% endblock %}", engine=engine),
+        template_backend)
+    view = pjax_block("main", context_processors='auto')(TemplateResponse)
+    assert view(pjax_request, template, {}).rendered_content == "[]"
+    request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#main",
+                     HTTP_X_CART="hat")
+    assert view(request, template, {}).rendered_content == "[hat]"
+
+    with pytest.raises(ValueError):
+        pjax_block("main", context_processors='all')
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+    expiring = LRUCache(timeout=-1)
+    expiring.set('a', 1)
+    assert expiring.get('a') is None
+
+
+def test_pjax_block_fragment_cache():
+    for cache in (LocalFragmentCache(), 'default'):
+        view = pjax_block("main", title_variable="title", cache=cache,
+                          cache_key=lambda request: request.path)(base_view)
+        first = view(pjax_request, file_template, {'title': 'First'})
+        assert first.rendered_content == ("<title>First</title>\n"
+                                          "file base block content")
+        second = view(pjax_request, file_template, {'title': 'Second'})
+        assert second.rendered_content == first.rendered_content
+
+        # Fragments aren't shared between different keys.
+        other_path = rf.get('/other/', HTTP_X_PJAX=True,
+                            HTTP_X_PJAX_CONTAINER="#main")
+        third = view(other_path, file_template, {'title': 'Third'})
+        assert third.rendered_content.startswith("<title>Third</title>")
+
+        # POST requests neither get the cached fragment nor replace it.
+        post = rf.post('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#main")
+        response = view(post, file_template, {'title': 'Errors'})
+        assert response.rendered_content.startswith("<title>Errors</title>")
+        response = view(pjax_request, file_template, {'title': 'Fourth'})
+        assert response.rendered_content == first.rendered_content
+
+    # Nor does a POST request that comes first fill the cache.
+    view = pjax_block("main", title_variable="title", cache=LocalFragmentCache(),
+                      cache_key=lambda request: request.path)(base_view)
+    view(post, file_template, {'title': 'Errors'}).render()
+    response = view(pjax_request, file_template, {'title': 'First'})
+    assert not response.renders_from_cache()
+    assert response.rendered_content.startswith("<title>First</title>")
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+def test_pjax_block_slice_pages():
+    stored = []
+
+    class RecordingCache(LocalFragmentCache):
+        def set(self, key, fragment):
+            stored.append(key)
+            super(RecordingCache, self).set(key, fragment)
+
+    caches['default'].clear()
+    view = pjax_block("main", title_variable="title", cache=RecordingCache(),
+                      cache_key=lambda request: request.path,
+                      slice_pages=True)(base_view)
+    cached_view = cache_page(60)(view)
+    page = cached_view(rf.get('/'), file_template, {'title': 'Page'}).render()
+    assert page.content == b"outside of block file base block content"
+    assert len(stored) == 1
+
+    response = view(pjax_request, file_template, {'title': 'Other'})
+    assert response.renders_from_cache()
+    assert response.rendered_content == ("<title>Page</title>\n"
+                                         "file base block content")
+
+    # The offsets of a page are only stored once.
+    view(rf.get('/'), file_template, {'title': 'Page'}).render()
+    assert len(stored) == 1
+
+    # Pages that Django's cache middleware hasn't cached aren't sliced.
+    view(rf.get('/other/'), file_template, {'title': 'Page'}).render()
+    response = view(rf.get('/other/', HTTP_X_PJAX=True,
+                           HTTP_X_PJAX_CONTAINER="#main"),
+                    file_template, {'title': 'Other'})
+    assert not response.renders_from_cache()
+
+    # Blocks whose output is altered by the tags around them aren't sliced.
+    template = Template("{% filter upper %}{% block a %}a{% endblock %}"
+                        "{% endfilter %}{% block b %}b{% endblock %}")
+    djpj.template.DjPjTemplate.patch(template)
+    context = Context()
+    context.djpj_page_blocks = page_blocks = djpj.template.PageBlocks()
+    content = template.render(context)
+    assert content == 'Ab'
+    assert page_blocks.offsets(content) == {'b': (1, 2)}
+
+    # Filters see a block's output as it is, including through block.super
+    # once the cached base template is patched by a render of its own.
+    locmem = 'django.template.loaders.locmem.Loader'
+    loaders = [('django.template.loaders.cached.Loader', [(locmem, {
+        'base.html': '{% block main %}A long base block text{% endblock %}',
+        'page.html': '{% extends "base.html" %}{% block main %}'
+                     '{{ block.super|truncatechars:12 }} / '
+                     '{{ block.super|length }}{% endblock %}'})])]
+    with override_settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {'loaders': loaders}}]):
+        view(rf.get('/base/'), 'base.html', {'title': 'Base'}).render()
+        for _ in range(2):
+            page = view(rf.get('/page/'), 'page.html', {'title': 'Page'})
+            assert page.rendered_content == u"A long base\u2026 / 22"
+        cached_view(rf.get('/page/'), 'page.html', {'title': 'Page'}).render()
+        response = view(rf.get('/page/', HTTP_X_PJAX=True,
+                               HTTP_X_PJAX_CONTAINER="#main"), 'page.html')
+        assert response.renders_from_cache()
+        assert response.rendered_content == (u"<title>Page</title>\n"
+                                             u"A long base\u2026 / 22")
+
+
+def test_pjax_block_coalesce():
+    rendering, release = threading.Event(), threading.Event()
+    renders = []
+
+    def slow_processor(request):
+        renders.append(request)
+        if request.method == 'GET':
+            rendering.set()
+            release.wait(5)
+        return {}
+
+    view = pjax_block("main", context_processors=[slow_processor],
+                      coalesce=lambda request: 'anonymous')(base_view)
+    key = fragment_cache_key(file_template, "main", None, None, 'anonymous')
+    responses = [view(pjax_request, file_template) for _ in range(3)]
+    contents = []
+    threads = [threading.Thread(target=lambda r=r: contents.append(
+        r.rendered_content)) for r in responses]
+    threads[0].start()
+    rendering.wait(5)
+
+    # POST requests render their own fragment rather than sharing a GET's.
+    post = rf.post('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#main")
+    post_thread = threading.Thread(target=lambda: contents.append(
+        view(post, file_template).rendered_content))
+    post_thread.start()
+    post_thread.join(2)
+    assert not post_thread.is_alive()
+    assert len(renders) == 2
+
+    for thread in threads[1:]:
+        thread.start()
+    while in_flight.waiters(key) < 2:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert contents == ["file base block content"] * 4
+    assert len(renders) == 2
+
+    # Errors are shared with the waiting calls.
+    flight, errors = SingleFlight(), []
+    rendering.clear()
+    release.clear()
+
+    def fail():
+        rendering.set()
+        release.wait(5)
+        raise KeyError('broken')
+
+    def call():
+        try:
+            flight.do('key', fail, 5)
+        except KeyError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    threads[0].start()
+    rendering.wait(5)
+    threads[1].start()
+    while flight.waiters('key') < 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+    # Renders aren't coalesced when the key function returns None.
+    view = pjax_block("main", coalesce=lambda request: None)(base_view)
+    assert view(pjax_request, file_template).rendered_content == \
+        "file base block content"
+
+
+def test_pjax_block_fragment_cache_requires_key():
+    with pytest.raises(ValueError):
+        pjax_block("main", cache=LocalFragmentCache())
+
+
+def test_pjax_block_content_etag():
+    view = pjax_block(etag=True)(base_view)
+    response = view(pjax_request, test_template).render()
+    assert response.status_code == 200
+    etag = response['ETag']
+
+    request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#secondary",
+                     HTTP_IF_NONE_MATCH=etag)
+    not_modified = view(request, test_template).render()
+    assert not_modified.status_code == 304
+    assert not_modified['ETag'] == etag
+    assert 'X-PJAX-Container' in not_modified['Vary']
+
+    # The same content in another container gets a different ETag.
+    request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#main",
+                     HTTP_IF_NONE_MATCH=etag)
+    view = pjax_block("secondary", etag=True)(base_view)
+    assert view(request, test_template).render().status_code == 200
+
+    # Errors are never answered with a 304.
+    view = pjax_block(etag=True)(lambda request, template: TemplateResponse(
+        request, template, {'colour': "orange"}, status=404))
+    request.META['HTTP_X_PJAX_CONTAINER'] = "#secondary"
+    response = view(request, test_template).render()
+    assert response.status_code == 404
+    assert not response.has_header('ETag')
+
+
+def test_pjax_block_version_etag():
+    versions = []
+    view = pjax_block(etag=lambda request: versions.append(1) or 'v1')(base_view)
+    response = view(pjax_request, test_template)
+    assert isinstance(response, PJAXTemplateResponse)
+    request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#secondary",
+                     HTTP_IF_NONE_MATCH=response['ETag'])
+    not_modified = view(request, test_template)
+    assert not_modified.status_code == 304
+    assert not_modified.render() is not_modified
+    assert versions == [1, 1]
+    assert view(regular_request, test_template).status_code == 200
+    assert versions == [1, 1]
+
+    # A stacked decorator passes the 304 on.
+    outer = pjax_template("pjax.html")(view)
+    assert outer(request, test_template).status_code == 304
+
+    # Multi-fragment responses for the same containers have their own ETag.
+    request.META['HTTP_X_DJPJ_CONTAINERS'] = '#secondary'
+    response = view(request, test_template)
+    assert response.status_code == 200
+    assert 'X-DjPj-Containers' in response['Vary']
+
+    # So do the title-less fragments that fill in {% pjax_lazy %} blocks.
+    del request.META['HTTP_X_DJPJ_CONTAINERS']
+    request.META['HTTP_X_DJPJ_LAZY'] = 'secondary'
+    assert view(request, test_template).status_code == 200
+
+    # Errors are never answered with a 304, even with a matching version.
+    del request.META['HTTP_X_DJPJ_LAZY']
+    view = pjax_block(etag=lambda request: 'v1')(
+        lambda request, template: TemplateResponse(request, template, {},
+                                                   status=500))
+    assert view(request, test_template).status_code == 500
+
+
+def test_middleware_etag_configuration():
+    middleware = DjangoPJAXMiddleware((('^/', '@pjax_block(etag=True)'),))
+    response = middleware.process_template_response(
+        pjax_request, base_view(pjax_request, test_template))
+    assert response.render().has_header('ETag')
+
+
+def test_middleware_version_etag_configuration():
+    middleware = DjangoPJAXMiddleware(
+        (('^/', '@pjax_block(etag="tests.version_etag")'),))
+    response = middleware.process_template_response(
+        pjax_request, base_view(pjax_request, test_template))
+    request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#secondary",
+                     HTTP_IF_NONE_MATCH=response['ETag'])
+    response = middleware.process_template_response(
+        request, base_view(request, test_template))
+    # Django renders whatever template response middleware returns.
+    assert response.render().status_code == 304
+    assert response['ETag'] == request.META['HTTP_IF_NONE_MATCH']
+
+
+def version_etag(request):
+    return 'v1'
+
+
+def test_pjax_block_streaming():
+    view = pjax_block("main", title_block="title", stream=True)(base_view)
+    with override_settings(DJPJ_RENDER_BLOCKS_DIRECTLY=True):
+        response = view(pjax_request, test_template)
+        assert isinstance(response, djpj.template.StreamingPJAXResponse)
+        assert response['X-PJAX-URL'] == pjax_request.get_full_path()
+        chunks = [c.decode('utf-8') for c in response.streaming_content]
+        assert chunks == ["<title>Block Title</title>\n",
+                          "I'm wearing ", "orange", " ", "galoshes"]
+
+        missing_title = pjax_block("main", title_variable="missing",
+                                   stream=True)(base_view)
+        with pytest.raises(KeyError):
+            missing_title(pjax_request, test_template)
+
+    # Without direct rendering, the whole fragment arrives at once.
+    response = view(pjax_request, test_template)
+    assert list(response.streaming_content) == [
+        b"<title>Block Title</title>\nI'm wearing orange galoshes"]
+
+    missing_block = pjax_block("missing", stream=True)(base_view)
+    with pytest.raises(TemplateSyntaxError):
+        missing_block(pjax_request, test_template)
+
+
+def test_pjax_block_streaming_cleanup():
+    exits = []
+    direct_render_state = djpj.template._direct_render_state
+
+    @contextmanager
+    def recording_render_state(*args):
+        try:
+            with direct_render_state(*args) as located:
+                yield located
+        except BaseException as e:
+            exits.append(type(e))
+            raise
+        exits.append(None)
+
+    view = pjax_block("main", stream=True)(base_view)
+    djpj.template._direct_render_state = recording_render_state
+    try:
+        with override_settings(DJPJ_RENDER_BLOCKS_DIRECTLY=True):
+            # Closing the response early ends the render state with the
+            # exception that closed it.
+            response = view(pjax_request, test_template)
+            next(response.streaming_content)
+            response.close()
+            assert exits == [GeneratorExit]
+            assert b''.join(
+                view(pjax_request, test_template).streaming_content) == \
+                b"I'm wearing orange galoshes"
+            assert exits == [GeneratorExit, None]
+    finally:
+        djpj.template._direct_render_state = direct_render_state
+
+
+def test_frame_fragments():
+    fragments = [('main', 'Caf\u00e9 \U0001F600'), ('cart', '<!--djpj-fragment x 1-->')]
+    assert split_fragments("<title>T</title>" + frame_fragments(fragments)) \
+        == ("<title>T</title>", fragments)
+    assert split_fragments("plain") == ("plain", [])
+
+
+def test_pjax_block_multiple_blocks():
+    view = pjax_block(["main", "secondary"], title_block="title")(base_view)
+    response = view(pjax_request, test_template)
+    assert response['X-DjPj-Fragments'] == 'main,secondary'
+    assert split_fragments(response.rendered_content) == (
+        "<title>Block Title</title>\n",
+        [('main', "I'm wearing orange galoshes"),
+         ('secondary', "Some secondary content.")])
+
+    missing = pjax_block(["main", "missing"])(base_view)
+    with pytest.raises(TemplateSyntaxError):
+        _ = missing(pjax_request, test_template).rendered_content
+
+
+def test_pjax_block_containers_header():
+    request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#main",
+                     HTTP_X_DJPJ_CONTAINERS="#main, #title")
+    assert pjax_containers(request) == ['main', 'title']
+    assert pjax_containers(pjax_request) == 'secondary'
+    response = view_pjax_block_auto(request, test_template)
+    assert split_fragments(response.rendered_content)[1] == [
+        ('main', "I'm wearing orange galoshes"), ('title', "Block Title")]
+
+
+def test_middleware_multiple_blocks_configuration():
+    middleware = DjangoPJAXMiddleware(
+        (('^/', '@pjax_block(["main", "secondary"])'),))
+    response = middleware.process_template_response(
+        pjax_request, base_view(pjax_request, test_template))
+    assert [name for name, _ in split_fragments(response.rendered_content)[1]] \
+        == ['main', 'secondary']
+
+
+def test_batch_view():
+    request = rf.get('/batch/?path=/page/%3Fcolour%3Dred&container=main'
+                     '&path=/redirect/&container=main'
+                     '&path=/missing/&container=main'
+                     '&path=http://example.com/page/&container=main'
+                     '&path=/page/&container=%23main'
+                     '&path=/plain/&container=main')
+    expected = [(200, '/page/?colour=red', "I'm wearing red galoshes"),
+                (302, '/redirected/', ''),
+                (404, '/missing/', ''),
+                (400, 'http://example.com/page/', ''),
+                (200, '/page/', "I'm wearing orange galoshes"),
+                (404, '/plain/', '')]
+    for threads in (0, 2):
+        with override_settings(ROOT_URLCONF='tests',
+                               DJPJ_BATCH_THREADS=threads):
+            response = batch(request)
+        assert response.status_code == 200
+        assert split_items(response.content.decode('utf-8')) == expected
+
+    # URLs matched by DJPJ_PJAX_URLS are served as the middleware would.
+    with override_settings(ROOT_URLCONF='tests', DJPJ_PJAX_URLS=[
+            (r'^/plain/$', '@pjax_block("main")')]):
+        response = batch(rf.get('/batch/?path=/plain/&container=main'))
+    assert split_items(response.content.decode('utf-8')) == [
+        (200, '/plain/', "I'm wearing orange galoshes")]
+
+    # Items skip the middleware, sharing the batch request's session.
+    del batch_sessions[:]
+    request = rf.get('/batch/?path=/session/&container=main'
+                     '&path=/session/&container=main')
+    request.session = object()
+    with override_settings(
+            ROOT_URLCONF='tests', DJPJ_BATCH_THREADS=2,
+            SESSION_ENGINE='django.contrib.sessions.backends.cache',
+            MIDDLEWARE=['django.contrib.sessions.middleware.SessionMiddleware']):
+        assert [status for status, _, _ in split_items(
+            batch(request).content.decode('utf-8'))] == [200, 200]
+    assert batch_sessions == [request.session] * 2
+
+    assert batch(rf.post('/batch/')).status_code == 405
+    assert batch(rf.get('/batch/?path=/page/')).status_code == 400
+    with override_settings(DJPJ_BATCH_MAX_ITEMS=1):
+        assert batch(rf.get('/batch/?path=/a/&container=a'
+                            '&path=/b/&container=b')).status_code == 400
+
+
+def test_follow_redirects():
+    def request(path, method='get'):
+        return getattr(rf, method)(path, HTTP_X_PJAX=True,
+                                   HTTP_X_PJAX_CONTAINER="#main")
+
+    with override_settings(ROOT_URLCONF='tests', ALLOWED_HOSTS=['testserver'],
+                           DJPJ_FOLLOW_REDIRECTS=2):
+        for method in ('get', 'post'):
+            response = view_redirect(request('/to/', method),
+                                     '/page/?colour=red')
+            assert response.status_code == 200
+            assert response.content == b"I'm wearing red galoshes"
+            assert response['X-PJAX-URL'] == '/page/?colour=red'
+            assert response['Vary'] == ('X-PJAX-Container, X-DjPj-Containers, '
+                                        'X-DjPj-Lazy')
+
+        # What the redirect sets, such as a language cookie, is kept.
+        response = view_redirect_setting_language(request('/to/'), '/page/')
+        assert response.content == b"I'm wearing orange galoshes"
+        assert response.cookies['language'].value == 'fr'
+        assert response['Content-Language'] == 'fr'
+        assert response['Vary'] == ('X-PJAX-Container, X-DjPj-Containers, '
+                                    'X-DjPj-Lazy, Accept-Language')
+
+        # The followed request passes through the project's middleware.
+        with override_settings(MIDDLEWARE=['tests.DenyPageMiddleware']):
+            assert view_redirect(request('/to/'), '/page/').status_code == 302
+
+        # It sees what the view did to the request's session, user and
+        # messages, which the middleware doesn't replace.
+        with override_settings(
+                MESSAGE_STORAGE='tests.MemoryMessageStorage',
+                MIDDLEWARE=['django.contrib.messages.middleware.'
+                            'MessageMiddleware']):
+            saving = request('/to/', 'post')
+            saving._messages = MemoryMessageStorage(saving)
+            response = view_redirect_with_message(saving, '/messages/')
+            assert response.content == b"[Saved!]"
+            # The message isn't kept for the next page as well.
+            saving._messages.update(response)
+            assert saving._messages.stored == []
+
+        # The hop limit ends redirect loops, leaving the client to follow.
+        response = view_redirect(request('/loop/'), 'http://testserver/loop/')
+        assert response.status_code == 302
+        assert response['X-PJAX-URL'] == '/loop/'
+
+        # Other hosts, missing pages and non-PJAX requests aren't followed.
+        for path, redirect_to in ((request('/to/'), 'http://example.com/'),
+                                  (request('/to/'), '/missing/'),
+                                  (rf.get('/to/'), '/page/')):
+            assert view_redirect(path, redirect_to).status_code == 302
+
+    assert view_redirect(request('/to/'), '/page/').status_code == 302
+
+
+def test_pjax_skip():
+    engine = Engine(libraries={'djpj': 'djpj.templatetags.djpj'})
+    template = DjangoTemplate(Template(
+        "{% load djpj %}{% pjax_skip %}[{{ sidebar }}]{% endpjax_skip %}"
+        "{% block main %}{{ colour }}{% pjax_skip %}!{{ sidebar }}"
+        "{% endpjax_skip %}{% endblock %}", engine=engine), template_backend)
+    evaluated = []
+
+    def sidebar():
+        evaluated.append(1)
+        return "sidebar"
+
+    view = pjax_block("main")(TemplateResponse)
+    response = view(regular_request, template, {'colour': "orange"})
+    assert response.rendered_content == "[]orange!"
+    for settings_ in ({}, {'DJPJ_PATCH_TEMPLATES': False},
+                      {'DJPJ_RENDER_BLOCKS_DIRECTLY': True}):
+        with override_settings(DJPJ_LAZY_CONTEXT=True, **settings_):
+            response = view(pjax_request, template,
+                            {'colour': "orange", 'sidebar': sidebar})
+            assert response.rendered_content == "orange"
+    assert evaluated == []
+
+    with pytest.raises(TemplateSyntaxError):
+        Template("{% load djpj %}{% pjax_skip x %}{% endpjax_skip %}",
+                 engine=engine)
+
+
+def test_pjax_lazy():
+    engine = Engine(libraries={'djpj': 'djpj.templatetags.djpj'})
+    template = DjangoTemplate(Template(
+        "{% load djpj %}{% block title %}Title{% endblock %}"
+        "{% block main %}{{ colour }} "
+        "{% pjax_lazy 'recs' %}{{ colour }} hat{% endpjax_lazy %}"
+        "{% endblock %}", engine=engine), template_backend)
+    view = pjax_block("main", title_block="title")(TemplateResponse)
+    placeholder = '<div data-djpj-lazy="recs" data-djpj-url="/"></div>'
+    lazy_request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#recs",
+                          HTTP_X_DJPJ_LAZY="recs")
+
+    response = view(regular_request, template, {'colour': "orange"})
+    assert response.rendered_content == "Titleorange " + placeholder
+    for settings_ in ({}, {'DJPJ_PATCH_TEMPLATES': False},
+                      {'DJPJ_RENDER_BLOCKS_DIRECTLY': True}):
+        with override_settings(**settings_):
+            response = view(pjax_request, template, {'colour': "orange"})
+            assert response.rendered_content == \
+                "<title>Title</title>\norange " + placeholder
+            response = view(lazy_request, template, {'colour': "orange"})
+            assert response.rendered_content == "orange hat"
+            assert 'X-DjPj-Lazy' in response['Vary']
+
+    # Without a request, there's nowhere to fetch the block from.
+    assert template.template.render(Context({'colour': "red"})) == \
+        "Titlered red hat"
+    with pytest.raises(TemplateSyntaxError):
+        Template("{% load djpj %}{% block a %}{% endblock %}"
+                 "{% pjax_lazy 'a' %}{% endpjax_lazy %}", engine=engine)
+
+
+def test_pjax_version():
+    view = pjax_block("main")(base_view)
+    root_version = djpj.template.layout_version(
+        template_backend.get_template(file_template).template)
+    engine = Engine(dirs=['tests/'],
+                    libraries={'djpj': 'djpj.templatetags.djpj'})
+    page = engine.from_string("{% extends 'test_template.html' %}{% load djpj %}"
+                              "{% block main %}{% pjax_version %}{% endblock %}")
+    assert page.render(Context()) == ('outside of block <meta http-equiv='
+                                      '"x-pjax-version" content="%s">'
+                                      % root_version)
+
+    with override_settings(DJPJ_PJAX_VERSION=True):
+        # A template shares the version of the templates it extends.
+        response = view(pjax_request, 'test_extends_template.html')
+        assert response['X-PJAX-Version'] == root_version
+        assert response.rendered_content == "extended block content"
+        assert view(pjax_request, file_template)['X-PJAX-Version'] == \
+            root_version
+
+        request = rf.get('/', HTTP_X_PJAX=True, HTTP_X_PJAX_CONTAINER="#main",
+                         HTTP_X_PJAX_VERSION=root_version)
+        assert view(request, 'test_extends_template.html').rendered_content \
+            == "extended block content"
+        request.META['HTTP_X_PJAX_VERSION'] = 'stale'
+        response = view(request, 'test_extends_template.html')
+        assert response.render() is response
+        assert response.content == b''
+        assert response['X-PJAX-Version'] == root_version
+
+        # Through the middleware too, Django renders what it returns.
+        middleware = DjangoPJAXMiddleware((('^/', '@pjax_block("main")'),))
+        response = middleware.process_template_response(
+            request, base_view(request, 'test_extends_template.html'))
+        assert response.render().content == b''
+        assert response['X-PJAX-Version'] == root_version
+
+        # The version is the page's, not that of a template swapped in for
+        # PJAX requests by a decorator applied first.
+        swapped = pjax_block("main")(pjax_template(test_template)(base_view))
+        response = swapped(pjax_request, 'test_extends_template.html')
+        assert response['X-PJAX-Version'] == root_version
+
+    assert not view(pjax_request, file_template).has_header('X-PJAX-Version')
+
+
+def test_response_rendered_signal():
+    received = []
+
+    def receiver(sender, response, stats, **kwargs):
+        received.append(stats)
+
+    response_rendered.connect(receiver)
+    try:
+        view_pjax_block(pjax_request, test_template).render()
+        with override_settings(DJPJ_RENDER_BLOCKS_DIRECTLY=True):
+            view_pjax_block(pjax_request, test_template).render()
+        view_pjax_block(regular_request, test_template).render()
+    finally:
+        response_rendered.disconnect(receiver)
+
+    walked, direct, full = received
+    assert walked.mode == 'patched' and walked.stopped_early
+    assert walked.fragment_size == len("I'm wearing orange galoshes")
+    assert 0 < walked.nodes_rendered < walked.nodes_total
+    assert list(walked.timings) == ['index', 'render', 'total']
+    assert direct.mode == 'direct' and direct.nodes_total == walked.nodes_total
+    assert direct.nodes_rendered < walked.nodes_rendered
+    assert full.mode == 'full' and full.nodes_rendered is None
+
+    # Without a receiver or Server-Timing header, nothing is measured.
+    assert view_pjax_block(pjax_request, test_template).djpj_stats is None
+
+
+def test_node_counts_use_rendered_chain():
+    received, resolved = [], []
+    resolve = djpj.template._resolve_inheritance_chain
+
+    def receiver(sender, response, stats, **kwargs):
+        received.append(stats)
+
+    def counting_resolve(template, context):
+        resolved.append(template)
+        return resolve(template, context)
+
+    response_rendered.connect(receiver)
+    djpj.template._resolve_inheritance_chain = counting_resolve
+    try:
+        view = pjax_block("secondary")(base_view)
+        context = {'base_template': base_template}
+        view(pjax_request, extends_template, dict(context)).render()
+        assert resolved == []
+        with override_settings(DJPJ_RENDER_BLOCKS_DIRECTLY=True):
+            view(pjax_request, extends_template, dict(context)).render()
+        assert len(resolved) == 1
+    finally:
+        djpj.template._resolve_inheritance_chain = resolve
+        response_rendered.disconnect(receiver)
+
+    walked, direct = received
+    assert walked.nodes_total == direct.nodes_total > 0
+
+
+def test_server_timing_header():
+    middleware = DjangoPJAXMiddleware((('^/', '@pjax_block(title_block="title")'),))
+    with override_settings(DJPJ_SERVER_TIMING=True):
+        response = middleware.process_template_response(
+            pjax_request, base_view(pjax_request, test_template)).render()
+    assert response['Server-Timing'].startswith('djpj;desc="patched ')
+    assert 'djpj-dispatch;dur=' in response['Server-Timing']
+    assert 'djpj-total;dur=' in response['Server-Timing']
+
+
+def test_metrics_registry():
+    registry = MetricsRegistry()
+    registry.inc('djpj_requests_total', ('view', 'pjax'))
+    thread = threading.Thread(target=registry.inc,
+                              args=('djpj_requests_total', ('view', 'pjax'), 2))
+    thread.start()
+    thread.join()
+    for value in (0.002, 0.02, 10):
+        registry.observe('djpj_render_seconds', ('view', 'direct'), value)
+    text = registry.prometheus_text()
+    assert 'djpj_requests_total{endpoint="view",kind="pjax"} 3\n' in text
+    assert 'djpj_render_seconds_bucket{endpoint="view",mode="direct",le="0.0025"} 1\n' in text
+    assert 'djpj_render_seconds_bucket{endpoint="view",mode="direct",le="2.5"} 2\n' in text
+    assert 'djpj_render_seconds_bucket{endpoint="view",mode="direct",le="+Inf"} 3\n' in text
+    assert 'djpj_render_seconds_count{endpoint="view",mode="direct"} 3\n' in text
+
+
+def test_metrics_recorded():
+    registry.clear()
+    middleware = DjangoPJAXMiddleware((('^/', '@pjax_block("main")'),))
+    missing = pjax_block("missing")(base_view)
+    with override_settings(DJPJ_METRICS=True):
+        view_pjax_block(pjax_request, test_template).render()
+        view_pjax_block(regular_request, test_template).render()
+        middleware.process_template_response(
+            pjax_request, base_view(pjax_request, test_template)).render()
+        # A response that already varies on the containers is still counted.
+        middleware.process_template_response(
+            regular_request, view_pjax_block(regular_request, test_template))
+        with pytest.raises(TemplateSyntaxError):
+            missing(pjax_request, test_template).render()
+
+    collected = registry.collect()
+    view = 'tests.base_view'
+    assert collected[('djpj_requests_total', (view, 'pjax'))] == 2
+    assert collected[('djpj_requests_total', (view, 'full'))] == 2
+    assert collected[('djpj_requests_total', ('^/', 'pjax'))] == 1
+    assert collected[('djpj_requests_total', ('^/', 'full'))] == 1
+    assert collected[('djpj_render_seconds', (view, 'patched'))][-1] == 1
+    assert collected[('djpj_render_seconds', (view, 'full'))][-1] == 1
+    assert collected[('djpj_fragment_bytes', ('^/', 'patched'))][-2] == \
+        len("I'm wearing orange galoshes")
+    assert collected[('djpj_errors_total', (view, 'TemplateSyntaxError'))] == 1
+    assert metrics(rf.get('/metrics/'))['Content-Type'].startswith('text/plain')
+
+
+def async_rf():
+    from django.test import AsyncRequestFactory
+    return AsyncRequestFactory()
+
+
+def async_view(response):
+    # A coroutine function, without async syntax, which Python 2 can't parse.
+    import asyncio
+    from djpj.aio import mark_coroutine_function
+    return mark_coroutine_function(
+        lambda request, *args: asyncio.sleep(0, response(request, *args)))
+
+
+@pytest.mark.skipif(django.VERSION < (3, 1), reason="requires async views")
+def test_async_pjax_block():
+    import asyncio
+    from djpj.compat import iscoroutinefunction
+
+    render_threads, process_threads = [], []
+    def view(request):
+        response = base_view(request, test_template)
+        response.add_post_render_callback(
+            lambda r: render_threads.append(threading.current_thread().name))
+        return response
+
+    def block(request):
+        process_threads.append(threading.current_thread())
+        return "main"
+
+    wrapped_view = pjax_block(block)(async_view(view))
+    assert iscoroutinefunction(wrapped_view)
+    request = async_rf().get('/', **{'x-pjax': 'true',
+                                     'x-pjax-container': '#main'})
+    response = asyncio.run(wrapped_view(request))
+    assert response['X-PJAX-URL'] == '/'
+    response = asyncio.run(response.render())
+    assert response.content == b"I'm wearing orange galoshes"
+    assert render_threads[0].startswith('djpj-render')
+    assert not iscoroutinefunction(response.render)
+
+    # Responses are processed on the event loop, unless that may block.
+    assert process_threads == [threading.current_thread()]
+    streaming_view = pjax_block(block, stream=True)(async_view(view))
+    response = asyncio.run(streaming_view(request))
+    assert b''.join(response.streaming_content) == \
+        b"I'm wearing orange galoshes"
+    assert process_threads[1] is not threading.current_thread()
+
+
+@pytest.mark.skipif(django.VERSION < (3, 1), reason="requires async views")
+def test_async_middleware():
+    import asyncio
+    from djpj.compat import iscoroutinefunction
+
+    config = (('^/', '@pjax_block("main")'),)
+    request = async_rf().get('/?_pjax=%23main', **{
+        'x-pjax': 'true', 'x-pjax-container': '#main'})
+    middleware = DjangoPJAXMiddleware(async_view(lambda _: HttpResponse()),
+                                      config)
+    assert iscoroutinefunction(middleware)
+    assert asyncio.run(middleware(request)).status_code == 200
+    assert '_pjax' not in request.GET
+    response = asyncio.run(middleware.process_template_response(
+        request, base_view(request, test_template)))
+    assert asyncio.run(response.render()).content == \
+        b"I'm wearing orange galoshes"
+
+    # Synchronous get_response functions get a synchronous middleware.
+    middleware = DjangoPJAXMiddleware(lambda _: HttpResponse(), config)
+    assert not iscoroutinefunction(middleware)
+    assert middleware(request).status_code == 200
+
+
+@pytest.mark.skipif(django.VERSION < (3, 1), reason="requires async views")
+def test_async_view_through_handlers():
+    import asyncio
+    from django.test import AsyncClient, Client
+
+    headers = {'x-pjax': 'true', 'x-pjax-container': '#main'}
+    with override_settings(ROOT_URLCONF='tests', ALLOWED_HOSTS=['testserver']):
+        # Django's synchronous handler renders responses synchronously.
+        client = Client()
+        assert b"Some text outside" in client.get('/async/').content
+        assert client.get('/async/', HTTP_X_PJAX=True,
+                          HTTP_X_PJAX_CONTAINER="#main").content == \
+            b"I'm wearing orange galoshes"
+
+        client = AsyncClient()
+        response = asyncio.run(client.get('/async/', **headers))
+        assert response.content == b"I'm wearing orange galoshes"
+        assert response['X-PJAX-URL'] == '/async/'
+
+
 def test_object_wrapping_direct_instantiation():
     response = base_view(pjax_request, test_template)
     with pytest.raises(NotImplementedError):
@@ -376,3 +1579,87 @@ def view_pjax_block_redirect(_):
 @pjax_block()
 def view_pjax_block_not_deferred(_):
     return HttpResponse("Some text!")
+
+
+@pjax_block("main")
+def view_batch_page(request):
+    return TemplateResponse(request, test_template,
+                            {'colour': request.GET.get('colour', 'orange')})
+
+
+batch_sessions = []
+
+
+@pjax_block("main")
+def view_batch_session(request):
+    batch_sessions.append(request.session)
+    return TemplateResponse(request, test_template, {})
+
+
+@pjax_block("main")
+def view_redirect(_, redirect_to):
+    return HttpResponseRedirect(redirect_to)
+
+
+@pjax_block("main")
+def view_redirect_setting_language(_, redirect_to):
+    response = HttpResponseRedirect(redirect_to)
+    response.set_cookie('language', 'fr')
+    response['Content-Language'] = 'fr'
+    response['Vary'] = 'Accept-Language'
+    return response
+
+
+class MemoryMessageStorage(BaseStorage):
+    """Keeps the messages it's asked to store for the next request."""
+
+    stored = None
+
+    def _get(self, *args, **kwargs):
+        return [], True
+
+    def _store(self, messages, response, *args, **kwargs):
+        self.stored = list(messages)
+        return []
+
+
+@pjax_block("main")
+def view_redirect_with_message(request, redirect_to):
+    messages.success(request, "Saved!")
+    return HttpResponseRedirect(redirect_to)
+
+
+@pjax_block("main")
+def view_messages(request):
+    return TemplateResponse(request, DjangoTemplate(Template(
+        "{% block main %}[{% for m in messages %}{{ m }}{% endfor %}]"
+        "{% endblock %}"), template_backend),
+        {'messages': messages.get_messages(request)})
+
+
+class DenyPageMiddleware(object):
+    """Denies access to /page/, as an access check in middleware would."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view, args, kwargs):
+        if request.path == '/page/':
+            return HttpResponseForbidden()
+
+
+urlpatterns = [
+    re_path(r'^page/$', view_batch_page),
+    re_path(r'^plain/$', base_view, {'template': test_template}),
+    re_path(r'^session/$', view_batch_session),
+    re_path(r'^messages/$', view_messages),
+    re_path(r'^redirect/$', view_pjax_block_redirect),
+    re_path(r'^loop/$', view_redirect, {'redirect_to': '/loop/'}),
+]
+
+if django.VERSION >= (3, 1):
+    urlpatterns.append(re_path(r'^async/$', pjax_block("main")(async_view(
+        lambda request: base_view(request, test_template)))))